@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+## @file bench_main_loop.py
+#  Measure how the Plancton main loop scales with the number of containers.
+#
+#  For each container count N, a fake Docker daemon (see fakedocker.py) is started in its own process
+#  with N running workers, and a fake InfluxDB receives monitoring. Plancton runs a few main loops
+#  against them, with the host load pinned at the CPU setpoint so that the container count does not
+#  change by itself. Workers get a fake cgroup v2 tree, so that usage is read as on a real host.
+#  Reported per tick: wall time, CPU time of the daemon, Docker API calls, and time spent in the main
+#  phases. Startup (adopting N unknown workers) is reported apart, and the first tick is not measured.
+#  Each N runs in a separate process, so that results do not depend on the previous runs.
+#
+#  Results can be saved as JSON and compared with a previous run: the exit code is non-zero if tick
+#  time, CPU time or API calls grew more than the tolerance.
+
+import json, os, sys, time, shutil, subprocess, tempfile, logging, resource
+from argparse import ArgumentParser, SUPPRESS
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+PHASES = [ "_collect_usage", "_launch_containers", "_control_containers", "_fill_pool",
+           "_dump_container_list" ]
+
+def median(values):
+  values = sorted(values)
+  return values[len(values)//2] if values else 0
+
+def cpu_time():
+  ru = resource.getrusage(resource.RUSAGE_SELF)
+  return ru.ru_utime + ru.ru_stime
+
+# Create cgroup v2 directories for the running containers which do not have one yet.
+def fake_cgroups(root, sock):
+  from fakedocker import control
+  for c in control(sock, "/containers/json"):
+    d = os.path.join(root, "system.slice", "docker-%s.scope" % c["Id"])
+    if c["State"] != "running" or os.path.isdir(d):
+      continue
+    os.makedirs(d)
+    for name, content in [ ("cpu.stat", "usage_usec 1000\nuser_usec 800\nsystem_usec 200\n"),
+                           ("memory.current", "1048576\n"),
+                           ("io.stat", "8:0 rbytes=4096 wbytes=4096 rios=1 wios=1\n") ]:
+      with open(os.path.join(d, name), "w") as f:
+        f.write(content)
+
+def wait_for(path, timeout=10):
+  deadline = time.time() + timeout
+  while not os.path.exists(path):
+    if time.time() > deadline:
+      raise RuntimeError("%s did not appear" % path)
+    time.sleep(0.05)
+
+# Run the benchmark for `n` containers in this process. Returns a dict of results.
+def run_one(n, ticks, churn, latency, fail, events, foreign):
+  from fakedocker import control
+  from plancton import Plancton
+  from plancton.cgroups import CgroupCollector
+  tmp = tempfile.mkdtemp(prefix="plancton-bench-")
+  procs = []
+  try:
+    for d in [ "log", "run", "conf", "cgroup" ]:
+      os.mkdir(os.path.join(tmp, d))
+    sock = os.path.join(tmp, "docker.sock")
+    cmd = [ sys.executable, os.path.join(here, "fakedocker.py"), sock, "--containers", str(n),
+            "--foreign", str(foreign) ]
+    for x in latency:
+      cmd += [ "--latency", x ]
+    for x in fail:
+      cmd += [ "--fail", x ]
+    procs.append(subprocess.Popen(cmd, stderr=open(os.devnull, "w")))
+    port = 18086 + os.getpid() % 1000
+    procs.append(subprocess.Popen([ sys.executable, os.path.join(here, "fakeinflux.py"), "--port", str(port) ],
+                                  stderr=open(os.devnull, "w")))
+    wait_for(sock)
+    with open(os.path.join(tmp, "conf", "config.yaml"), "w") as f:
+      f.write("max_docks: %d\ncpus_per_dock: 0.01\nmax_dock_mem: 1000000\nmax_dock_swap: 0\n" \
+              "docker_events: %s\ninfluxdb_url: http://127.0.0.1:%d#plancton\n" % \
+              (n, "true" if events else "false", port))
+    p = Plancton("plancton", pidfile=os.path.join(tmp, "run", "plancton.pid"),
+                 logdir=os.path.join(tmp, "log"), rundir=os.path.join(tmp, "run"),
+                 confdir=os.path.join(tmp, "conf"), socket_url="unix://" + sock)
+    logging.getLogger().handlers = []  # no console output, only the daemon log file
+    cgroot = os.path.join(tmp, "cgroup")
+    open(os.path.join(cgroot, "cgroup.controllers"), "w").close()
+    fake_cgroups(cgroot, sock)
+    p._cgroups = CgroupCollector(cgroot)
+    p._set_cpu_efficiency = lambda: setattr(p, "efficiency", float(p.conf["cpu_setpoint"]))
+    timing = dict([ (x, 0.0) for x in PHASES ])
+    def timed(name, f):
+      def wrapper(*args, **kwargs):
+        t = time.time()
+        try:
+          return f(*args, **kwargs)
+        finally:
+          timing[name] += time.time() - t
+      return wrapper
+    for name in PHASES:
+      setattr(p, name, timed(name, getattr(p, name)))
+    control(sock, "/_fake/reset", {})
+    cpu0 = cpu_time()
+    t0 = time.time()
+    p.init()
+    if p.conf["max_docks"] != n:
+      raise RuntimeError("configuration not applied, see %s/log/plancton.log" % tmp)
+    deadline = time.time() + 10
+    while not all([ p._image_id(pool) for pool in p.pools ]) and time.time() < deadline:
+      time.sleep(0.01)
+    init = { "wall": time.time() - t0, "cpu": cpu_time() - cpu0,
+             "calls": sum(control(sock, "/_fake/reset", {}).values()) }
+    results = []
+    for i in range(ticks+1):
+      if churn and i > 0:
+        control(sock, "/_fake/exit", { "count": churn })
+      fake_cgroups(cgroot, sock)
+      control(sock, "/_fake/reset", {})
+      for name in PHASES:
+        timing[name] = 0.0
+      cpu0 = cpu_time()
+      t0 = time.time()
+      p.main_loop()
+      wall = time.time() - t0
+      cpu = cpu_time() - cpu0
+      calls = control(sock, "/_fake/reset", {})
+      results.append({ "wall": wall,
+                       "cpu": cpu,
+                       "calls": sum(calls.values()),
+                       "endpoints": calls,
+                       "phases": dict(timing) })
+    p.onexit()
+    if p._events:
+      p._events.stop()
+    p._flush_streamers()
+    rest = results[1:]
+    return { "n": n,
+             "scenario": { "churn": churn, "latency": sorted(latency), "fail": sorted(fail), "events": events,
+                           "foreign": foreign },
+             "init_wall": init["wall"],
+             "init_cpu": init["cpu"],
+             "init_calls": init["calls"],
+             "wall": median([ x["wall"] for x in rest ]),
+             "wall_max": max([ x["wall"] for x in rest ]),
+             "cpu": median([ x["cpu"] for x in rest ]),
+             "calls": median([ x["calls"] for x in rest ]),
+             "endpoints": rest[-1]["endpoints"],
+             "phases": dict([ (k, median([ x["phases"][k] for x in rest ])) for k in PHASES ]) }
+  finally:
+    for proc in procs:
+      proc.terminate()
+      proc.wait()
+    shutil.rmtree(tmp, True)
+
+def report(results):
+  cols = [ ("N", "%6d", "n", 1), ("init ms", "%8.1f", "init_wall", 1000), ("init calls", "%10d", "init_calls", 1),
+           ("tick ms", "%8.1f", "wall", 1000), ("max ms", "%8.1f", "wall_max", 1000),
+           ("CPU ms", "%8.1f", "cpu", 1000), ("calls", "%6d", "calls", 1) ]
+  phases = [ ("usage", "_collect_usage"), ("launch", "_launch_containers"), ("control", "_control_containers"),
+             ("pool", "_fill_pool"), ("dump", "_dump_container_list") ]
+  print " ".join([ "%*s" % (len(f % 0), name) for name, f, _, _ in cols ] +
+                 [ "%8s" % ("%s ms" % x) for x, _ in phases ])
+  for r in results:
+    print " ".join([ f % (r[k]*scale) for _, f, k, scale in cols ] +
+                   [ "%8.1f" % (r["phases"][k]*1000) for _, k in phases ])
+
+# Compare with a previous run of the same scenario. Returns the list of regressions.
+def compare(results, baseline, tolerance):
+  base = dict([ (r["n"], r) for r in baseline ])
+  regressions = []
+  for r in results:
+    b = base.get(r["n"])
+    if not b:
+      continue
+    if b.get("scenario") != r["scenario"]:
+      print "N=%d: not comparable, baseline scenario is %s" % (r["n"], json.dumps(b.get("scenario")))
+      continue
+    for key, floor in [ ("wall", 0.005), ("cpu", 0.005), ("calls", 1) ]:
+      if r[key] > max(b[key], floor) * (1+tolerance):
+        regressions.append("N=%d: %s %.3g, was %.3g" % (r["n"], key, r[key], b[key]))
+  return regressions
+
+if __name__ == "__main__":
+  parser = ArgumentParser(description="Benchmark the Plancton main loop against a fake Docker daemon.")
+  parser.add_argument("--counts", default="10,50,100,500,1000,2000",
+                      help="comma-separated container counts (default: %(default)s)")
+  parser.add_argument("--ticks", type=int, default=5, help="measured ticks per count (default: %(default)s)")
+  parser.add_argument("--churn", type=int, default=0, help="containers exiting before each tick")
+  parser.add_argument("--events", action="store_true", help="follow Docker events")
+  parser.add_argument("--foreign", type=int, default=0, help="other containers running on the host")
+  parser.add_argument("--latency", action="append", default=[], metavar="ENDPOINT=S",
+                      help="Docker API latency, e.g. \"*=0.002\" or \"GET /containers/json=0.05\"")
+  parser.add_argument("--fail", action="append", default=[], metavar="ENDPOINT=P",
+                      help="Docker API failure probability, e.g. \"POST /containers/{id}/start=0.1\"")
+  parser.add_argument("--save", metavar="FILE", help="write results as JSON")
+  parser.add_argument("--compare", metavar="FILE", help="compare with results saved by --save")
+  parser.add_argument("--tolerance", type=float, default=0.5,
+                      help="relative growth considered a regression (default: %(default)s)")
+  parser.add_argument("--one", type=int, help=SUPPRESS)  # internal: run one count, print JSON
+  args = parser.parse_args()
+
+  if args.one is not None:
+    print json.dumps(run_one(args.one, args.ticks, args.churn, args.latency, args.fail, args.events, args.foreign))
+    sys.stdout.flush()
+    os._exit(0)  # do not wait for the daemon threads
+
+  results = []
+  for n in [ int(x) for x in args.counts.split(",") ]:
+    cmd = [ sys.executable, os.path.abspath(__file__), "--one", str(n), "--ticks", str(args.ticks),
+            "--churn", str(args.churn), "--foreign", str(args.foreign) ] + (["--events"] if args.events else [])
+    for x in args.latency:
+      cmd += [ "--latency", x ]
+    for x in args.fail:
+      cmd += [ "--fail", x ]
+    out = subprocess.check_output(cmd)
+    results.append(json.loads(out.strip().split("\n")[-1]))
+  report(results)
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump(results, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    for r in regressions:
+      print "Regression: %s" % r
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+## @file fakedocker.py
+#  Scriptable fake Docker Engine API served on a Unix socket.
+#
+#  Implements the subset of the API used by Plancton: containers (list, create, start, inspect,
+#  remove), images (pull, inspect, registry digest), ping, version and events. Every request is
+#  counted per endpoint, and can be delayed or made to fail with a given probability.
+#  The fake is scripted through extra endpoints, either from the same process or over the socket
+#  with `control()`:
+#    GET  /_fake/calls       calls per endpoint since the last reset
+#    POST /_fake/reset       reset call counters
+#    POST /_fake/config      { "latency": { endpoint: s }, "failures": { endpoint: probability } }
+#    POST /_fake/containers  { "count": n, "state": "running", "prefix": "plancton-worker", "labels": {} }
+#    POST /_fake/exit        { "count": n }: make n running Plancton containers exit
+#  Endpoints are written as "METHOD /path", with container IDs replaced by {id}; "*" matches all.
+
+import BaseHTTPServer, SocketServer, httplib, socket
+import json, os, re, sys, time, random, threading, urlparse, Queue
+from argparse import ArgumentParser
+
+STATUS = { "running": "Up 1 minute",
+           "exited": "Exited (0) 1 second ago",
+           "created": "Created" }
+
+class FakeDocker(object):
+
+  def __init__(self, path, latency=None, failures=None, digest="sha256:" + "0"*64):
+    self.path = path
+    self.latency = latency or {}
+    self.failures = failures or {}
+    self.digest = digest
+    self.containers = {}
+    self.images = {}
+    self.calls = {}
+    self.lock = threading.Lock()
+    self._subscribers = []
+    self._server = None
+
+  def start(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    self._server = _Server(self.path, _Handler)
+    self._server.fake = self
+    t = threading.Thread(target=self._server.serve_forever, name="fakedocker")
+    t.daemon = True
+    t.start()
+    return self
+
+  def stop(self):
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+  # Add containers as created by Plancton, with its owner label unless `labels` is given.
+  def add_containers(self, count, state="running", prefix="plancton-worker", labels=None):
+    now = time.time()
+    with self.lock:
+      for _ in range(count):
+        cid = _random_id()
+        self.containers[cid] = { "Id": cid, "Name": "%s-%s" % (prefix, cid[:6]), "Created": int(now),
+                                 "State": state, "Started": now, "Finished": now,
+                                 "Labels": { "plancton.owner": prefix } if labels is None else labels }
+
+  def exit_containers(self, count):
+    with self.lock:
+      running = [ c for c in self.containers.values()
+                  if c["State"] == "running" and c["Name"].startswith("plancton-") ][:count]
+      for c in running:
+        c["State"] = "exited"
+        c["Finished"] = time.time()
+    for c in running:
+      self.emit("die", c)
+    return len(running)
+
+  def reset(self):
+    with self.lock:
+      calls, self.calls = self.calls, {}
+    return calls
+
+  def emit(self, action, c):
+    ev = { "Type": "container", "Action": action, "status": action, "id": c["Id"], "time": int(time.time()),
+           "Actor": { "ID": c["Id"], "Attributes": { "name": c["Name"] } } }
+    for q in list(self._subscribers):
+      q.put(ev)
+
+  def _count(self, endpoint):
+    with self.lock:
+      self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+    delay = self.latency.get(endpoint, self.latency.get("*", 0))
+    if delay:
+      time.sleep(delay)
+    return random.random() < self.failures.get(endpoint, self.failures.get("*", 0))
+
+  # Returns (code, body) for a request.
+  def handle(self, method, path, query, body):
+    if path.startswith("/_fake/"):
+      return self._control(method, path, body)
+    endpoint = "%s %s" % (method, re.sub(r"/containers/[0-9a-f]{12,}", "/containers/{id}", path))
+    if self._count(endpoint):
+      return 500, { "message": "injected failure" }
+    if path == "/_ping":
+      return 200, "OK"
+    if path == "/version":
+      return 200, { "ApiVersion": "1.24", "Version": "1.12.0" }
+    if path == "/containers/json":
+      filters = json.loads(query.get("filters", [ "{}" ])[0])
+      with self.lock:
+        return 200, [ { "Id": c["Id"], "Names": [ "/" + c["Name"] ], "Created": c["Created"],
+                        "State": c["State"], "Status": STATUS[c["State"]], "Image": c.get("Image"),
+                        "Labels": c.get("Labels") or {} }
+                      for c in self.containers.values() if _matches(c, filters) ]
+    if path == "/containers/create":
+      cid = _random_id()
+      conf = json.loads(body or "{}")
+      with self.lock:
+        self.containers[cid] = { "Id": cid, "Name": query["name"][0], "Created": int(time.time()),
+                                 "State": "created", "Image": conf.get("Image"), "Labels": conf.get("Labels"),
+                                 "HostConfig": conf.get("HostConfig") or {} }
+      return 201, { "Id": cid, "Warnings": None }
+    m = re.match(r"^/containers/([0-9a-f]+)(/start|/json)?$", path)
+    if m:
+      c = self.containers.get(m.group(1))
+      if not c:
+        return 404, { "message": "no such container" }
+      if m.group(2) == "/start":
+        c["State"] = "running"
+        c["Started"] = time.time()
+        self.emit("start", c)
+        return 204, None
+      if m.group(2) == "/json":
+        return 200, { "Id": c["Id"], "Name": "/" + c["Name"],
+                      "HostConfig": c.get("HostConfig", {}),
+                      "State": { "Pid": 4242 if c["State"] == "running" else 0,
+                                 "StartedAt": _docker_time(c.get("Started", c["Created"])),
+                                 "FinishedAt": _docker_time(c.get("Finished", c["Created"])) } }
+      if method == "DELETE":
+        with self.lock:
+          self.containers.pop(c["Id"], None)
+        self.emit("destroy", c)
+        return 204, None
+    if path == "/images/create":
+      name = "%s:%s" % (query["fromImage"][0], query.get("tag", ["latest"])[0])
+      self.images[name] = { "Id": "sha256:" + _random_id(), "RepoDigests": [ name.split(":")[0] + "@" + self.digest ] }
+      return 200, { "status": "Downloaded newer image for %s" % name }
+    m = re.match(r"^/images/(.+)/json$", path)
+    if m:
+      name = m.group(1) if ":" in m.group(1) else m.group(1) + ":latest"
+      return (200, self.images[name]) if name in self.images else (404, { "message": "no such image" })
+    if re.match(r"^/distribution/(.+)/json$", path):
+      return 200, { "Descriptor": { "digest": self.digest } }
+    return 404, { "message": "page not found" }
+
+  def _control(self, method, path, body):
+    args = json.loads(body or "{}")
+    if path == "/_fake/calls":
+      with self.lock:
+        return 200, dict(self.calls)
+    if path == "/_fake/reset":
+      return 200, self.reset()
+    if path == "/_fake/config":
+      self.latency.update(args.get("latency", {}))
+      self.failures.update(args.get("failures", {}))
+      return 200, { "latency": self.latency, "failures": self.failures }
+    if path == "/_fake/containers":
+      self.add_containers(args.get("count", 1), args.get("state", "running"),
+                          args.get("prefix", "plancton-worker"), args.get("labels"))
+      return 200, { "containers": len(self.containers) }
+    if path == "/_fake/exit":
+      return 200, { "exited": self.exit_containers(args.get("count", 1)) }
+    return 404, { "message": "unknown control endpoint" }
+
+  def subscribe(self):
+    q = Queue.Queue()
+    self._subscribers.append(q)
+    return q
+
+  def unsubscribe(self, q):
+    self._subscribers.remove(q)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def address_string(self):
+    return "unix"
+
+  def _reply(self, code, obj):
+    body = json.dumps(obj) if obj is not None else ""
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _events(self):
+    fake = self.server.fake
+    q = fake.subscribe()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+    try:
+      while True:
+        data = json.dumps(q.get()) + "\n"
+        self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+    except Exception:
+      fake.unsubscribe(q)
+
+  def _route(self, method):
+    url = urlparse.urlparse(self.path)
+    path = re.sub(r"^/v[0-9.]+", "", url.path)
+    length = int(self.headers.get("Content-Length") or 0)
+    body = self.rfile.read(length) if length else ""
+    if path == "/events":
+      return self._events()
+    self._reply(*self.server.fake.handle(method, path, urlparse.parse_qs(url.query), body))
+
+  def do_GET(self):
+    self._route("GET")
+
+  def do_POST(self):
+    self._route("POST")
+
+  def do_DELETE(self):
+    self._route("DELETE")
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+  def __init__(self, path):
+    httplib.HTTPConnection.__init__(self, "localhost")
+    self.path = path
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self.path)
+
+# Call a control endpoint of a fake Docker listening on `path`, and return the decoded reply.
+def control(path, endpoint, args=None):
+  conn = _UnixHTTPConnection(path)
+  try:
+    conn.request("POST" if args is not None else "GET", endpoint, json.dumps(args) if args is not None else None)
+    return json.loads(conn.getresponse().read())
+  finally:
+    conn.close()
+
+# Whether a container matches list filters: every label (key or key=value), a name substring and a
+# state, each filter matching any of its values.
+def _matches(c, filters):
+  labels = c.get("Labels") or {}
+  for label in filters.get("label", []):
+    k, eq, v = label.partition("=")
+    if k not in labels or (eq and labels[k] != v):
+      return False
+  if filters.get("name") and not any([ x in c["Name"] for x in filters["name"] ]):
+    return False
+  return not filters.get("status") or c["State"] in filters["status"]
+
+def _random_id():
+  return "%064x" % random.getrandbits(256)
+
+def _docker_time(ts):
+  return time.strftime("%Y-%m-%dT%H:%M:%S.000000000Z", time.gmtime(ts))
+
+# Parse "endpoint=value" options into a dict.
+def parse_endpoints(values):
+  return dict([ (k, float(v)) for k, v in [ x.rsplit("=", 1) for x in values or [] ] ])
+
+if __name__ == "__main__":
+  parser = ArgumentParser(description="Serve a fake Docker API on a Unix socket.")
+  parser.add_argument("socket", help="path of the Unix socket to create")
+  parser.add_argument("--containers", type=int, default=0, help="running plancton-worker containers")
+  parser.add_argument("--foreign", type=int, default=0, help="running containers not belonging to Plancton")
+  parser.add_argument("--latency", action="append", metavar="ENDPOINT=S",
+                      help="delay responses of an endpoint, e.g. \"GET /containers/json=0.01\"")
+  parser.add_argument("--fail", action="append", metavar="ENDPOINT=P",
+                      help="fail requests to an endpoint with probability P")
+  args = parser.parse_args()
+  fake = FakeDocker(args.socket, latency=parse_endpoints(args.latency), failures=parse_endpoints(args.fail))
+  fake.add_containers(args.containers)
+  fake.add_containers(args.foreign, prefix="other", labels={})
+  fake.start()
+  sys.stderr.write("Fake Docker listening on %s\n" % args.socket)
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    fake.stop()
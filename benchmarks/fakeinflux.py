@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+## @file fakeinflux.py
+#  Fake InfluxDB HTTP sink.
+#
+#  Accepts writes (POST /write) and queries (GET /query, used to create databases), counts requests
+#  and points, and can delay responses or reject writes.
+
+import BaseHTTPServer, SocketServer, threading, time, sys
+from argparse import ArgumentParser
+
+class FakeInfluxDB(object):
+
+  def __init__(self, port=0, latency=0, fail=False):
+    self.latency = latency
+    self.fail = fail
+    self.writes = 0
+    self.points = 0
+    self.queries = 0
+    self.lock = threading.Lock()
+    self._server = _Server(("127.0.0.1", port), _Handler)
+    self._server.fake = self
+    self.port = self._server.server_address[1]
+
+  def url(self, database="plancton"):
+    return "http://127.0.0.1:%d#%s" % (self.port, database)
+
+  def start(self):
+    t = threading.Thread(target=self._server.serve_forever, name="fakeinflux")
+    t.daemon = True
+    t.start()
+    return self
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def stats(self):
+    with self.lock:
+      return { "writes": self.writes, "points": self.points, "queries": self.queries }
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  wbufsize = -1  # one write per response, or Nagle delays keep-alive clients
+
+  def log_message(self, *args):
+    pass
+
+  def _reply(self, code):
+    self.send_response(code)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+    self.wfile.flush()
+
+  def do_POST(self):
+    fake = self.server.fake
+    time.sleep(fake.latency)
+    body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+    if fake.fail:
+      return self._reply(500)
+    with fake.lock:
+      fake.writes += 1
+      fake.points += len([ x for x in body.split("\n") if x.strip() ])
+    self._reply(204)
+
+  def do_GET(self):
+    fake = self.server.fake
+    with fake.lock:
+      fake.queries += 1
+    self._reply(200)
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+if __name__ == "__main__":
+  parser = ArgumentParser(description="Serve a fake InfluxDB counting writes.")
+  parser.add_argument("--port", type=int, default=8086)
+  parser.add_argument("--latency", type=float, default=0, help="delay of each write (s)")
+  parser.add_argument("--fail", action="store_true", help="reject all writes")
+  args = parser.parse_args()
+  fake = FakeInfluxDB(args.port, args.latency, args.fail).start()
+  sys.stderr.write("Fake InfluxDB listening on %s\n" % fake.url())
+  try:
+    while True:
+      time.sleep(10)
+      sys.stderr.write("%s\n" % fake.stats())
+  except KeyboardInterrupt:
+    fake.stop()
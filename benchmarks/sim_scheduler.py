@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+## @file sim_scheduler.py
+#  Simulate a scheduler policy against a linear host model, and check that it settles.
+#
+#  The host load is an external load plus 100 × cpus_per_dock / ncpus percent per running container,
+#  capped at 100%, and follows the container count at once. The policy decides every main_sleep
+#  seconds, from the default configuration of Plancton. Scenarios:
+#    - fill: empty host, the setpoint is not a whole number of containers;
+#    - external: 25% of external load, again between two container counts;
+#    - peak: on a host just below the setpoint, the external load rises to 10% for one loop;
+#    - step: on the same host, the external load steps from 0% to 25% and stays.
+#  Reported: the container count at each loop. The exit code is non-zero if, once settled, the count
+#  changes direction (oscillation), or if the peak kills containers.
+
+import os, sys, logging
+from argparse import ArgumentParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from plancton.scheduler import Load, policies
+
+def simulate(policy, conf, ncpus, external, running, loops):
+  p = policies[policy]()
+  counts = []
+  for i in range(loops):
+    busy = min(100., external(i) + 100. * conf["cpus_per_dock"] * running / ncpus)
+    spawn, shed = p.decide(Load(i*conf["main_sleep"], busy, 100.-busy, running, ncpus, 0), conf)
+    running += spawn - shed
+    counts.append(running)
+  return counts
+
+# Changes of direction of the container count after loop `settled`.
+def reversals(counts, settled):
+  moves = [ b-a for a, b in zip(counts[settled:], counts[settled+1:]) if b != a ]
+  return len([ 1 for a, b in zip(moves, moves[1:]) if (a > 0) != (b > 0) ])
+
+if __name__ == "__main__":
+  parser = ArgumentParser(description="Simulate a Plancton scheduler policy against a linear host model.")
+  parser.add_argument("--policy", default="pi", choices=sorted(policies), help="default: %(default)s")
+  parser.add_argument("--ncpus", type=int, default=32, help="host CPUs (default: %(default)s)")
+  parser.add_argument("--max-docks", type=int, default=30, help="default: %(default)s")
+  parser.add_argument("--loops", type=int, default=40, help="main loops per scenario (default: %(default)s)")
+  args = parser.parse_args()
+
+  from plancton import Plancton
+  conf = dict(Plancton("plancton", pidfile=os.devnull, logdir=None, rundir="", confdir="").conf,
+              max_docks=args.max_docks)
+  logging.getLogger().setLevel(logging.WARNING)
+  half = args.loops // 2
+  full = min(args.max_docks, int(conf["cpu_setpoint"] * args.ncpus / (100. * conf["cpus_per_dock"])))
+  scenarios = [ ("fill",     0,      lambda i: 0.),
+                ("external", 0,      lambda i: 25.),
+                ("peak",     full-1, lambda i: 10. if i == half else 0.),
+                ("step",     full-1, lambda i: 25. if i >= half else 0.) ]
+  failed = []
+  for name, running, external in scenarios:
+    counts = simulate(args.policy, conf, args.ncpus, external, running, args.loops)
+    print "%-9s %s" % (name, " ".join([ str(x) for x in counts ]))
+    if reversals(counts, half if name == "step" else args.loops // 4) > 0:
+      failed.append("%s: the container count oscillates" % name)
+    if name == "peak" and min(counts) < running:
+      failed.append("peak: containers killed by a load peak of one loop")
+  for f in failed:
+    print "Failed: %s" % f
+  sys.exit(1 if failed else 0)
@@ -1,17 +1,32 @@
 # -*- coding: utf-8 -*-
 import docker, json, pprint, requests, yaml
-import base64, string, time, os, random, errno
+import base64, string, time, os, random, errno, threading, calendar, hashlib, urllib
 from functools import wraps
 from yaml import YAMLError
 from socket import gethostname
 import logging, logging.handlers
 from prettytable import PrettyTable
-from datetime import datetime
 from daemon import Daemon
 from docker import Client
 import docker.errors
 import sys
 from influxdb_streamer import InfluxDBStreamer
+from snapshot import ContainerSnapshot, container_name, container_state, OWNER_LABEL
+from events import ContainerEventWatcher
+from circuit import CircuitBreaker, CircuitOpenError
+from cgroups import CgroupCollector
+from cpuload import CpuLoadSampler
+from memory import MemorySampler, admission
+from scheduler import Load, policies, victims
+from control import ControlServer, control_request
+from config import WatchedFile, Expression, validate, drop_unknown
+from images import ImageUpdater, split_image
+from timing import Timings
+from metrics import MetricsRegistry, MetricsServer
+from pools import make_pools, pool_of, allocate, pick_victims
+from placement import Topology, CpusetAllocator
+from journal import Journal
+from logqueue import make_async, Deferred, JsonFormatter
 
 def apparmor_enabled():
   try:
@@ -28,48 +43,97 @@ def swap_size():
 def cpu_count():
   return int(os.sysconf("SC_NPROCESSORS_ONLN"))
 
-def cpu_times():
-  return [ float(x) for x in open('/proc/uptime').read().split(' ') ]
+# Table of containers for the log, from (id, state, status, name, pid) rows.
+def container_table(rows):
+  status_table = PrettyTable(['n\'', 'docker hash', 'status', 'docker name', '   pid   '])
+  status_table.align["   pid   "] = "r"
+  num = 0
+  for cid, state, status, name, pid in rows:
+    num = num+1
+    pid = "" if pid == 0 else str(pid)
+    status_table.add_row([num, cid[:12], status, name, pid])
+  return status_table
 
-def utc_time():
-  return time.mktime(datetime.utcnow().timetuple())
+# Values that can be used in the max_docks expression.
+max_docks_inputs = { "ram_bytes"     : lambda conf: mem_size(),
+                     "swap_bytes"    : lambda conf: swap_size(),
+                     "ncpus"         : lambda conf: cpu_count(),
+                     "max_dock_mem"  : lambda conf: conf["max_dock_mem"],
+                     "max_dock_swap" : lambda conf: conf["max_dock_swap"] }
 
-# Wrap API calls and catch exceptions to provide "robustness"
-def robust(tries=5, delay=3, backoff=2):
-  def robust_decorator(f):
+# Digest of image `name` in its registry, asked to Docker with GET /distribution/<name>/json. docker-py
+# has no call for it: the request is sent on the client itself, a requests.Session, using only its public
+# base_url and api_version (checked with docker-py 1.10.6, and docker 2.x APIClient).
+def registry_digest(client, name, timeout):
+  r = client.get("%s/v%s/distribution/%s/json" % (client.base_url, client.api_version,
+                                                   urllib.quote_plus(name, safe="/:")), timeout=timeout)
+  r.raise_for_status()
+  return r.json()["Descriptor"]["digest"]
+
+# Convert a Docker timestamp (e.g. 2016-10-17T10:00:00.123456789Z) to seconds since the epoch.
+# Parsed by hand: strptime is not safe to call for the first time from several threads in Python 2.
+def docker_time(ts):
+  d, t = ts[:19].split("T")
+  return calendar.timegm([ int(x) for x in d.split("-") + t.split(":") ])
+
+# Apply func to all items using at most `parallelism` threads. Results are returned in order, and func
+# is expected to handle its own exceptions. Plain threads are used: shutting down a ThreadPool takes
+# about 100 ms, as its handler thread polls.
+def parallel_map(func, items, parallelism):
+  items = list(items)
+  if parallelism <= 1 or len(items) <= 1:
+    return map(func, items)
+  results = [ None ] * len(items)
+  pending = iter(enumerate(items))
+  lock = threading.Lock()
+  def worker():
+    while True:
+      with lock:
+        try:
+          i, item = next(pending)
+        except StopIteration:
+          return
+      results[i] = func(item)
+  threads = [ threading.Thread(target=worker) for _ in range(min(parallelism, len(items))) ]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return results
+
+# Route Docker API calls through the Docker circuit breaker: once Docker is found unreachable, calls
+# fail immediately until the breaker sees it back. API errors (Docker answered, but with an error) do
+# not trip the breaker, and are retried right away up to `tries` times: use it for idempotent calls.
+# The duration of each call actually sent to Docker is recorded in `timings` as "docker.<method>".
+# Calls with `breaker=False` still fail fast while the circuit is open, but their own failures do not
+# open it: use it for calls whose slowness is not Docker's (e.g. Docker asking a registry).
+def docker_call(tries=1, breaker=True):
+  def docker_call_decorator(f):
+    def timed(self, *args, **kwargs):
+      with self.timings.timer("docker." + f.__name__):
+        return f(self, *args, **kwargs)
     @wraps(f)
-    def robust_call(self, *args, **kwargs):
-      ltries, ldelay = tries, delay
-      while ltries > 1:
+    def docker_call_wrapper(self, *args, **kwargs):
+      ltries = tries
+      while True:
         try:
-          return f(self, *args, **kwargs)
-        except requests.exceptions.ConnectionError as e:
-          self.logctl.warning("In %s: cannot connect to Docker, retrying in %d s: %s" % \
-                              (f.__name__, ldelay, e))
-          self.streamer(series="daemon",
-                        tags={ "hostname": self._hostname },
-                        fields={ "status": "waiting" })
-          time.sleep(ldelay)
-          ltries -= 1
-          ldelay *= backoff
-        except requests.exceptions.ReadTimeout as e: # Unresponsive docker daemon
-          self.logctl.warning("In %s: Docker timed out, retrying in %d s: %s" % \
-                              (f.__name__, ldelay, e))
-          time.sleep(ldelay)
-          ltries -= 1
-          ldelay *= backoff
+          if breaker:
+            return self.docker_breaker.call(timed, self, *args, **kwargs)
+          if self.docker_breaker.state != CircuitBreaker.CLOSED:
+            raise CircuitOpenError("Docker unavailable, not trying")
+          return timed(self, *args, **kwargs)
+        except CircuitOpenError:
+          raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+          self.logctl.warning("In %s: %s: %s", f.__name__, "cannot connect to Docker" if breaker else "no answer", e)
+          raise
         except docker.errors.DockerException as e:
-          self.logctl.warning("In %s: API request failed, retrying in %d seconds: %s" % \
-                              (f.__name__, ldelay, e))
-          self.streamer(series="daemon",
-                        tags={ "hostname": self._hostname },
-                        fields={ "status": "waiting" })
-          time.sleep(ldelay)
           ltries -= 1
-          ldelay *= backoff
-      raise Exception("In %s: call failed after %d attempts, giving up" % (f.__name__, tries))
-    return robust_call
-  return robust_decorator
+          if ltries < 1:
+            raise
+          self.logctl.warning("In %s: API request failed, retrying: %s", f.__name__, e)
+    return docker_call_wrapper
+  return docker_call_decorator
 
 class Lazy():
   def __init__(self, init_func):
@@ -82,63 +146,143 @@ class Lazy():
 
 class Plancton(Daemon):
   __version__ = '0.6.0'
-  @robust()
-  def container_list(self, all=True):
-    return self.docker_client().containers(all=all)
-  @robust()
+  @docker_call(tries=2)
+  def container_list(self, all=True, filters=None):
+    return self.docker_client().containers(all=all, filters=filters)
+  @docker_call()
   def container_remove(self, id, force):
-    return self.docker_client().remove_container(container=id, force=force)
-  @robust()
+    self._snapshot_stale = True
+    if self._events:
+      self._removing.add(id)
+    try:
+      r = self.docker_client().remove_container(container=id, force=force)
+    except Exception:
+      self._removing.discard(id)
+      raise
+    self._workers.pop(id, None)
+    if self._placement:
+      self._placement.release(id)
+    return r
+  @docker_call(tries=2)
   def docker_pull(self, repository, tag="latest"):
     self.logctl.debug("Pulling: repo %s tag %s" % (repository, tag))
     return self.docker_client().pull(repository=repository, tag=tag)
-  @robust()
+  @docker_call(tries=2)
+  def image_inspect(self, name):
+    return self.docker_client().inspect_image(name)
+  # Docker asks the registry: a slow registry must not open the Docker breaker, nor hold the refresh
+  # for the default timeout of the Docker client.
+  @docker_call(breaker=False)
+  def image_registry_digest(self, name):
+    return registry_digest(self.docker_client(), name, timeout=10)
+  @docker_call()
   def container_create_from_conf(self, jsonconf, name):
+    self._snapshot_stale = True
     return self.docker_client().create_container_from_config(config=jsonconf, name=name)
-  @robust()
+  @docker_call(tries=2)
   def container_inspect(self, id):
     return self.docker_client().inspect_container(container=id)
-  @robust()
+  @docker_call()
   def container_start(self, id):
+    self._snapshot_stale = True
     return self.docker_client().start(container=id)
   @property
   def idle(self):
-   return float(100 - self.efficiency)
+   return max(0.0, float(100 - self.efficiency - self.cpu_pressure))
 
   # Set daemon name, pidfile, log directory and location of docker socket.
   def __init__(self, name, pidfile, logdir, rundir, confdir,
                socket_url="unix://var/run/docker.sock"):
     super(Plancton, self).__init__(name, pidfile)
-    self._start_time = self._last_update_time = self._last_confup_time = time.time()
+    self._start_time = self._last_confup_time = time.time()
     self._last_kill_time = 0
-    self._overhead_first_time = 0
-    self.uptime0,self.idletime0 = cpu_times()
+    self._cpuload = CpuLoadSampler()
+    self.cpu_pressure = 0.0
+    self._memory = MemorySampler()
+    self.admission = ("accept", "")  # last admission decision and its reason
+    self.efficiency = 100.0
+    self._running = 0            # running containers at the end of the last tick
+    self._tick_start = None
+    self._tick_duration = None
     self._logdir = logdir
     self._rundir = rundir
     self._confdir = confdir
     self._sockpath = socket_url
     self._num_cpus = cpu_count()
     self._hostname = gethostname().split('.')[0]
+    self._instance = None        # hostname:pid:start time of the running daemon, labelled on workers
+    self._unlabelled = True      # workers created without labels may exist, see _containers
     self._cont_config = None  # container configuration (dict)
+    self._conf_file = WatchedFile(self._confdir+"/config.yaml")
+    self._max_docks_expr = None  # compiled max_docks Expression
     self._container_prefix = "plancton-worker"
     self._drainfile = self._rundir + "/drain"
     self._drainfile_stop = self._rundir + "/stop"
     self._fstopfile = self._rundir + "/force-stop"
+    self._ctlsock = self._rundir + "/control.sock"
+    self._control = None         # ControlServer answering on `_ctlsock`
     self._force_kill = False
     self._do_main_loop = True
-    self._has_image = False
+    self._images = {}            # image name -> ImageUpdater, for the images of all pools
+    self._image_refresh_at = {}  # image name -> next periodic refresh
+    self._pool = []              # (spec, container) created and ready to be started, see _fill_pool
+    self._pool_lock = threading.Lock()
+    self._placement = None       # CpusetAllocator, when cpuset is enabled
+    self._journal = None         # Journal of the worker lifecycle, when journal_days is set
+    self._journal_restored = set()  # ids not finished in the journal when opened, to check once
+    self._log_file = None        # handler of plancton.log, written from the log thread
+    self._log_listener = None    # QueueListener writing out log records in the background
+    self._dumped = (None, 0)     # last container table logged, and when
+    self._pool_stale = []        # pooled containers to remove
+    self._launch_credit = 0.     # CPUs granted to a pool waiting for room for its container
     self.streamers = set()
-    self.docker_client = Lazy(lambda: Client(base_url=self._sockpath, version="auto"))
+    self.metrics = MetricsRegistry()
+    self._metrics_server = None  # MetricsServer, when metrics_port is set
+    self._snapshot = None        # per-tick ContainerSnapshot
+    self._snapshot_stale = False # set when Plancton creates or removes containers
+    self._list_calls = 0         # container list calls done in this tick
+    self._list_saved = 0         # container list calls served by the snapshot in this tick
+    self._events = None          # ContainerEventWatcher, when following Docker events
+    self._wakeup = threading.Event()  # interrupts the sleep between two main loops
+    self._exited = set()         # ids of workers Docker events reported exited since the last loop
+    self._removing = set()       # ids of containers removed by Plancton, not to be waited for
+    self._workers = {}           # container id -> { "started": epoch, "pid": pid } of running workers
+    self._cgroups = CgroupCollector()
+    self.worker_usage = {}       # container id -> { "cpu": cores, "mem": bytes, "io": bytes/s }
+    self.idle_workers = 0
+    self.scheduler = None        # SchedulerPolicy deciding how many containers to launch or kill
+    self.docker_client = Lazy(self._docker_connect)
+    self.timings = Timings()     # durations of main loop phases ("tick.*") and Docker calls ("docker.*")
+    self.docker_breaker = CircuitBreaker("Docker", probe=lambda: self.docker_client().ping(),
+                                         trips=[ requests.exceptions.ConnectionError,
+                                                 requests.exceptions.Timeout ],
+                                         on_change=self._on_docker_circuit)
     self.conf = {
       "influxdb_url"      : set(),            # URL set to InfluxDB (with #database)
-      "updateconfig"      : 60,               # frequency of config updates (s)
+      "influxdb_batch"    : 100,              # send points to InfluxDB in batches of this size
+      "influxdb_flush"    : 60,               # max age of a buffered InfluxDB point (s)
+      "metrics_port"      : 0,                # serve Prometheus metrics on this port (0: disabled)
+      "metrics_bind"      : "",               # address of the metrics endpoint (all by default)
+      "updateconfig"      : 60,               # frequency of max_docks updates (s)
       "image_expiration"  : 43200,            # frequency of image updates (s)
+      "image_jitter"      : 0.1,              # vary image_expiration by this fraction
       "main_sleep"        : 30,               # main loop sleep (s)
-      "grace_kill"        : 120,              # kill after secs over CPU threshold
-      "grace_spawn"       : 60,               # spawn secs after last kill
+      "scheduler"         : "pi",             # container count policy: "pi" or "heuristic"
+      "cpu_setpoint"      : 90,               # target host CPU load (%)
+      "pi_kp"             : 0.3,              # pi: proportional gain
+      "pi_ki"             : 0.01,             # pi: integral gain (1/s)
+      "grace_kill"        : 120,              # kill after secs over CPU threshold (pi: below target)
+      "grace_spawn"       : 60,               # heuristic: spawn secs after last kill
       "cpus_per_dock"     : 1,                # number of CPUs per container (frac)
       "max_docks"         : "ncpus - 2",      # expression: compute max containers
       "docks_per_loop"    : 4,                # max docks launched each loop
+      "kills_per_loop"    : 0,                # max docks killed each loop (0: no limit)
+      "victims"           : "youngest",       # docks killed first: "youngest", "least_cpu", "most_mem"
+      "cpu_sampling"      : 5,                # sample CPU load every (s) while sleeping
+      "launch_parallelism": 4,                # max docks being launched at the same time
+      "warm_pool"         : 0,                # docks kept created, ready to be started
+      "inspect_parallelism": 8,               # max concurrent inspections of unknown docks
+      "kill_parallelism"  : 8,                # max docks being killed at the same time
       "max_ttl"           : 43200,            # max ttl for a container (12 hours)
       "docker_image"      : "busybox",        # Docker image: repository[:tag]
       "docker_cmd"        : "/bin/sleep 60",  # command to run (string or list)
@@ -149,20 +293,66 @@ class Plancton(Daemon):
       "binds"             : [],               # list of bind mounts (all read-only)
       "devices"           : [],               # list of exposed devices
       "capabilities"      : [],               # list of added caps (e.g. SYS_ADMIN)
-      "security_opts"     : []                # sec options (e.g. apparmor profile)
+      "security_opts"     : [],               # sec options (e.g. apparmor profile)
+      "docker_events"     : False,            # refill slots as soon as Docker reports an exit
+      "idle_dock_cpu"     : 0.05,             # docks using less CPU than this (cores) are idle
+      "mem_available_spawn": 10,              # no spawns below this available memory (% of RAM)
+      "mem_available_kill": 5,                # kill docks below this available memory (% of RAM)
+      "mem_pressure_spawn": 10,               # no spawns above this memory pressure (%, some avg10)
+      "mem_pressure_kill" : 20,               # kill docks above this memory pressure (%, full avg10)
+      "cpuset"            : False,            # pin each dock to CPUs and memory of one NUMA node
+      "journal_days"      : 30,               # keep dock history in rundir this long (0: no journal)
+      "log_format"        : "text",           # plancton.log format: "text", or "json" (one object per line)
+      "dump_interval"     : 600,              # log the dock table when it changes, or at least every (s)
+      "pools"             : {}                # named workload pools (see README), none: a single one
     }
+    self._conf_defaults = dict(self.conf)
+    self.pools = make_pools(self.conf, self._container_prefix)
+
+  # New Docker client. Not being able to get the API version means Docker cannot be reached.
+  def _docker_connect(self):
+    try:
+      return Client(base_url=self._sockpath, version="auto")
+    except docker.errors.DockerException as e:
+      raise requests.exceptions.ConnectionError(e)
+
+  # Containers snapshot shared by the whole tick. Docker is queried again only if Plancton created
+  # or removed containers since the last successful fetch. Only workers are listed, filtered by Docker on their
+  # owner label. Workers created by older versions have no labels: they are also listed by name until
+  # none of them is left.
+  def _containers(self):
+    if self._snapshot is None or self._snapshot_stale:
+      self._snapshot_stale = False
+      try:
+        containers = self.container_list(all=True, filters={ "label": "%s=%s" % (OWNER_LABEL, self._container_prefix) })
+        self._list_calls += 1
+        if self._unlabelled:
+          unlabelled = [ c for c in self.container_list(all=True, filters={ "name": self._container_prefix })
+                         if OWNER_LABEL not in (c.get("Labels") or {}) ]
+          self._list_calls += 1
+          if not unlabelled:
+            self.logctl.info("No workers without labels: listing workers by label only")
+            self._unlabelled = False
+          containers += unlabelled
+      except Exception:
+        self._snapshot_stale = True  # the snapshot is still the one from before the change
+        raise
+      self._snapshot = ContainerSnapshot(containers)
+      if self._events:
+        self._events.reconcile(self._snapshot.containers)
+    else:
+      self._list_saved += 1
+    return self._snapshot
 
   # Get only own running containers, youngest container first if reverse=True.
   def _filtered_list(self, name, reverse=True):
     self.logctl.debug("Fetching list of Plancton running containers")
     try:
-      jlist = self.container_list(all=True)
+      snap = self._containers()
     except Exception as e:
-      self.logctl.error("Couldn't get containers list, returning empty: %s" % e)
+      self.logctl.error("Couldn't get containers list, returning empty: %s", e)
       return []
-    fjlist = [ d for d in jlist if (d.get("Names", [""])[0][1:].startswith(name) and d["Status"].startswith("Up")) ]
-    srtlist = sorted(fjlist, key=lambda k: k["Created"], reverse=reverse)
-    return srtlist
+    return sorted(snap.running(name), key=lambda k: k["Created"], reverse=reverse)
 
   # Set up rotating logging system. Logfiles in: `self._logdir`.
   def _setup_log_files(self):
@@ -170,127 +360,441 @@ class Plancton(Daemon):
       os.mkdir(self._logdir, 0700)
     else:
       os.chmod(self._logdir, 0700)
-    format = '%(asctime)s %(name)s %(levelname)s [%(module)s.%(funcName)s] %(message)s'
-    datefmt = '%Y-%m-%d %H:%M:%S'
     log_file_handler = logging.handlers.RotatingFileHandler(self._logdir + '/plancton.log',
       mode='a', maxBytes=10000000, backupCount=50)
-    log_file_handler.setFormatter(logging.Formatter(format, datefmt))
+    log_file_handler.setFormatter(self._log_formatter())
     log_file_handler.doRollover()
     self.logctl.setLevel(logging.DEBUG)
     self.logctl.addHandler(log_file_handler)
+    self._log_file = log_file_handler
+    self._log_listener = make_async(self.logctl)
+
+  # Formatter of plancton.log for the configured log_format.
+  def _log_formatter(self):
+    if self.conf["log_format"] == "json":
+      return JsonFormatter()
+    return logging.Formatter('%(asctime)s %(name)s %(levelname)s [%(module)s.%(funcName)s] %(message)s',
+                             '%Y-%m-%d %H:%M:%S')
+
+  # Switch the format of plancton.log according to the configuration. The file is rotated, so that
+  # each file has a single format.
+  def _log_format_setup(self):
+    if self.conf["log_format"] not in [ "text", "json" ]:
+      self.logctl.error("Unknown log format %s, using text" % self.conf["log_format"])
+      self.conf["log_format"] = "text"
+    if not self._log_file or isinstance(self._log_file.formatter, JsonFormatter) == (self.conf["log_format"] == "json"):
+      return
+    self.logctl.info("Logging to %s/plancton.log as %s" % (self._logdir, self.conf["log_format"]))
+    self._log_file.acquire()
+    try:
+      self._log_file.doRollover()
+      self._log_file.setFormatter(self._log_formatter())
+    finally:
+      self._log_file.release()
 
-  # Parse configuration file `config.yaml` and change default value if specified.
+  # Read configuration file `config.yaml` if it changed, on top of the default values. A valid file
+  # replaces the whole configuration at once, an invalid one is ignored. Returns the changed options.
   def _read_conf(self):
+    if not self._conf_file.changed():
+      return set()
+    conf = self._load_conf_file()
+    if conf is None:
+      if self._max_docks_expr:
+        self.logctl.error("Keeping the current configuration")
+        return set()
+      self.logctl.error("Not launching containers until the configuration is fixed")
+      conf = { "max_docks": 0, "warm_pool": 0 }
+    new = dict(self._conf_defaults)
+    new.update([ x for x in conf.iteritems() if x[1] is not None ])
+    if not isinstance(new["docker_cmd"], list):
+      new["docker_cmd"] = new["docker_cmd"].split(" ")
+    if isinstance(new["influxdb_url"], basestring):
+      new["influxdb_url"] = set([new["influxdb_url"]])
+    else:
+      new["influxdb_url"] = set(filter(lambda x: "#" in x, new["influxdb_url"]))
+    new["pools"] = dict([ (k, dict(v or {})) for k, v in new["pools"].iteritems() ])
+    for opts in new["pools"].itervalues():
+      if isinstance(opts.get("docker_cmd"), basestring):
+        opts["docker_cmd"] = opts["docker_cmd"].split(" ")
+    expr = self._max_docks_expr
+    try:
+      if not expr or expr.source != str(new["max_docks"]):
+        expr = Expression(new["max_docks"], max_docks_inputs)
+      new["max_docks"] = self._eval_max_docks(expr, new)
+    except Exception as e:
+      self.logctl.error("configuration for max_docks is invalid: %s: %s" % (new["max_docks"], e))
+      if self._max_docks_expr:
+        self.logctl.error("Keeping the current configuration")
+        return set()
+      self.logctl.error("Not launching containers until max_docks is fixed")
+      expr = Expression(0, max_docks_inputs)
+      new["max_docks"] = 0
+    self._max_docks_expr = expr
+    changed = set([ k for k in new if new[k] != self.conf[k] ])
+    self.conf = new
+    self.pools = make_pools(self.conf, self._container_prefix)
+    if changed:
+      self.logctl.info("Configuration changed: %s" % ", ".join(sorted(changed)))
+      self.logctl.debug("Configuration:\n%s", Deferred(json.dumps, dict(self.conf), indent=2, default=list))
+    return changed
+
+  # Parse and validate the configuration file. Returns None if it cannot be used.
+  def _load_conf_file(self):
     try:
       conf = yaml.safe_load(open(self._confdir+"/config.yaml").read())
-    except (IOError, YAMLError) as e:
-      self.logctl.error("%s/config.yaml could not be read, using previous one: %s" % (self._confdir, e))
-      conf = {}
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return {}
+      self.logctl.error("%s/config.yaml could not be read: %s" % (self._confdir, e))
+      return None
+    except YAMLError as e:
+      self.logctl.error("%s/config.yaml could not be read: %s" % (self._confdir, e))
+      return None
     if conf is None:
-      conf = {}
-    for k in self.conf:
-      self.conf[k] = conf.get(k, self.conf[k])
+      return {}
+    if isinstance(conf, dict):
+      dropped = drop_unknown(conf)
+      if dropped:
+        self.logctl.warning("%s/config.yaml: ignoring unknown option(s) %s" % (self._confdir, ", ".join(dropped)))
+    errors = validate(conf) if isinstance(conf, dict) else [ "not a dictionary" ]
+    if errors:
+      self.logctl.error("%s/config.yaml is invalid: %s" % (self._confdir, "; ".join(errors)))
+      return None
+    return conf
+
+  def _eval_max_docks(self, expr, conf):
+    return int(expr.evaluate(lambda name: max_docks_inputs[name](conf)))
+
+  # Re-evaluate max_docks, in case the host resources it depends on changed.
+  def _update_max_docks(self):
     try:
-      self.conf["max_docks"] = int(eval(str(self.conf["max_docks"]),
-                                        { "ram_bytes": mem_size(),
-                                          "swap_bytes": swap_size(),
-                                          "ncpus": cpu_count(),
-                                          "max_dock_mem": conf["max_dock_mem"],
-                                          "max_dock_swap": conf["max_dock_swap"] }))
+      max_docks = self._eval_max_docks(self._max_docks_expr, self.conf)
     except Exception as e:
-      self.logctl.error("configuration for max_docks is invalid, falling back to zero: %s: %s" % \
-                        (self.conf["max_docks"], e))
-      self.conf["max_docks"] = 0
-    if not isinstance(self.conf["docker_cmd"], list):
-      self.conf["docker_cmd"] = self.conf["docker_cmd"].split(" ")
-    if isinstance(self.conf["influxdb_url"], str):
-      self.conf["influxdb_url"] = set([self.conf["influxdb_url"]])
-    elif isinstance(self.conf["influxdb_url"], list):
-      self.conf["influxdb_url"] = set(filter(lambda x: "#" in x, self.conf["influxdb_url"]))
-    else:
-      self.conf["influxdb_url"] = set()
-    self.logctl.debug("Configuration:\n%s" % json.dumps(self.conf, indent=2, default=list))
+      self.logctl.error("Cannot evaluate max_docks, keeping %d: %s: %s" % \
+                        (self.conf["max_docks"], self._max_docks_expr.source, e))
+      return
+    if max_docks != self.conf["max_docks"]:
+      self.logctl.info("Maximum number of containers changed from %d to %d" % \
+                       (self.conf["max_docks"], max_docks))
+      self.conf["max_docks"] = max_docks
 
   # Set up monitoring target.
   def _influxdb_setup(self):
-    self.streamers = set([ x for x in self.streamers if x.baseurl+"#"+x.database in self.conf["influxdb_url"] ])
-    for url in self.conf["influxdb_url"]:
-      self.streamers.add(InfluxDBStreamer(**dict(zip(["baseurl", "database"], url.split("#", 1)))))
+    gone = [ x for x in self.streamers if x.baseurl+"#"+x.database not in self.conf["influxdb_url"] ]
+    for streamer in gone:
+      streamer.close()
+    self.streamers.difference_update(gone)
+    current = set([ x.baseurl+"#"+x.database for x in self.streamers ])
+    for url in self.conf["influxdb_url"] - current:
+      self.streamers.add(InfluxDBStreamer(batch_size=self.conf["influxdb_batch"],
+                                          batch_age=self.conf["influxdb_flush"],
+                                          **dict(zip(["baseurl", "database"], url.split("#", 1)))))
+    for streamer in self.streamers:
+      streamer.batch_size = self.conf["influxdb_batch"]
+      streamer.batch_age = self.conf["influxdb_flush"]
+
+  # Start, restart or stop the metrics endpoint according to the configuration.
+  def _metrics_setup(self):
+    if self._metrics_server:
+      self._metrics_server.stop()
+      self._metrics_server = None
+    if not self.conf["metrics_port"]:
+      return
+    server = MetricsServer(self.metrics, self.conf["metrics_bind"], self.conf["metrics_port"])
+    try:
+      server.start()
+    except Exception as e:
+      self.logctl.error("Cannot serve metrics on port %d: %s" % (self.conf["metrics_port"], e))
+      return
+    self._metrics_server = server
+
+  # Queue a monitoring point on all streamers, and update metrics. Points are sent in the background.
+  def _stream(self, series, tags, fields):
+    for streamer in self.streamers:
+      streamer(series=series, tags=tags, fields=fields)
+    if self._metrics_server:
+      self.metrics.point(series, tags, fields)
+
+  # Send all buffered monitoring points from the calling thread: meant for shutdown.
+  def _flush_streamers(self):
+    for streamer in self.streamers:
+      streamer.flush()
+      self.logctl.info("Monitoring points to %s#%s: %s" % \
+                       (streamer.baseurl, streamer.database,
+                        ", ".join([ "%s=%d" % x for x in sorted(streamer.stats().items()) ])))
+
+  # Start or stop following Docker events according to the configuration.
+  def _events_setup(self):
+    if self.conf["docker_events"] and not self._events:
+      self.logctl.info("Tracking containers from Docker events, polling every %d s as fallback" % \
+                       self.conf["main_sleep"])
+      self._events = ContainerEventWatcher(self._docker_connect,
+                                           self._container_prefix,
+                                           on_change=self._on_container_event)
+      self._events.start()
+    elif not self.conf["docker_events"] and self._events:
+      self.logctl.info("Not tracking containers from Docker events anymore")
+      self._events.stop()
+      self._events = None
+
+  # Called when the Docker circuit breaker opens or closes.
+  def _on_docker_circuit(self, state):
+    self._stream(series="daemon",
+                 tags={ "hostname": self._hostname },
+                 fields={ "status": "waiting" if state != CircuitBreaker.CLOSED else "active",
+                          "docker": state })
+
+  # Called from the events thread: wake up the main loop when a worker slot is freed. Workers exiting by
+  # themselves are counted, for their slots to be refilled at once.
+  def _on_container_event(self, action, cid):
+    if cid in self._removing:
+      if action == "destroy":
+        self._removing.discard(cid)
+    elif action in [ "die", "destroy" ]:
+      if action == "die":
+        self._exited.add(cid)
+      self._wakeup.set()
+
+  # Slots to launch beyond what the scheduler decided, to refill the ones freed by `exited` workers: the
+  # load sampled before they exited does not show them yet. Nothing is refilled when killing.
+  def _refill(self, exited, spawn, shed, running):
+    if not exited or shed:
+      return spawn
+    refill = min(len(exited), max(self.conf["max_docks"] - running, 0), self.conf["docks_per_loop"])
+    if refill > spawn:
+      self.logctl.info("Refilling %d slot(s) freed by %d exited container(s)", refill, len(exited))
+      return refill
+    return spawn
 
-  # Efficiency is calculated subtracting idletime per cpu from uptime.
+  # Efficiency is the smoothed CPU load sampled from /proc/stat, including a last sample taken now.
+  # Until two samples are available the host is considered full.
   def _set_cpu_efficiency(self):
-    curruptime,curridletime = cpu_times()
-    deltaup = curruptime - self.uptime0
-    deltaidle = curridletime - self.idletime0
-    eff = float(100)
+    self._cpuload.sample()
+    eff = self._cpuload.value()
+    self.efficiency = 100.0 if eff is None else max(eff, 0.0)
+    self.cpu_pressure = self._cpuload.pressure
+
+  # Read resource usage of running workers from their cgroups, and send it to monitoring.
+  def _collect_usage(self):
+    if not self._cgroups.available():
+      return
     try:
-      eff = float((deltaup*self._num_cpus - deltaidle)*100) / float(deltaup*self._num_cpus)
-    except ZeroDivisionError as e:
-      pass
-    self.uptime0 = curruptime
-    self.idletime0 = curridletime
-    self.efficiency = eff if eff > 0 else 0.0
-
-  # Kill running containers exceeding a given CPU threshold.
-  def _overhead_control(self):
-    max_containers_cpu = 100 * self.conf["cpus_per_dock"] * min(self._count_containers(), self.conf["max_docks"]) / cpu_count()
-    if max_containers_cpu and self.efficiency > max_containers_cpu+10.:
-      if self._overhead_first_time == 0:
-        self._overhead_first_time = time.time()
-      now = time.time()
-      self.logctl.warning("Above CPU threshold of %.2f%% for %d/%d s" % (max_containers_cpu, now-self._overhead_first_time, self.conf["grace_kill"]))
-      if now-self._overhead_first_time > self.conf["grace_kill"]:
-        cont_list = self._filtered_list(name=self._container_prefix)
-        if cont_list:
-          self.logctl.debug("Killing container %s" % cont_list[0]["Id"])
-          try:
-            self.container_remove(cont_list[0]["Id"], force=True)
-            self._last_kill_time = time.time()
-          except Exception as e:
-            self.logctl.error("Cannot remove %s: %s", cont_list[0]["Id"], e)
-          else:
-            self.logctl.info('Container %s removed successfully' % cont_list[0]["Id"])
-        else:
-          self.logctl.debug('No workers found, nothing to do')
-          self._overhead_first_time = 0
+      workers = self._containers().running(self._container_prefix)
+    except Exception as e:
+      self.logctl.error("Couldn't get containers list, not collecting usage: %s", e)
+      return
+    self.worker_usage = self._cgroups.collect([ c["Id"] for c in workers ])
+    self.idle_workers = 0
+    for c in workers:
+      usage = self.worker_usage.get(c["Id"])
+      if not usage:
+        continue
+      if usage["cpu"] is not None and usage["cpu"] < self.conf["idle_dock_cpu"]:
+        self.idle_workers += 1
+      self._stream(series="container_usage",
+                   tags={ "hostname": self._hostname,
+                          "pool": self._pool_name(c),
+                          "container": container_name(c) },
+                   fields=dict([ x for x in usage.iteritems() if x[1] is not None ]))
+
+  # Start or stop placing workers on CPUs and NUMA nodes according to the configuration. Running
+  # workers are inspected again to account for their CPUs, and pooled containers, created with the
+  # previous placement, are replaced.
+  def _placement_setup(self):
+    if self.conf["cpuset"] == bool(self._placement):
+      return
+    if self.conf["cpuset"]:
+      try:
+        topology = Topology.read()
+      except Exception as e:
+        self.logctl.error("Cannot read the CPU topology, not pinning containers: %s" % e)
+        return
+      self.logctl.info("Pinning containers to CPUs, nodes: %s" % \
+                       ", ".join([ "%d (%d CPUs)" % (n, len(c)) for n, c in sorted(topology.nodes.items()) ]))
+      self._placement = CpusetAllocator(topology)
     else:
-      self._overhead_first_time = 0
+      self.logctl.info("Not pinning containers to CPUs anymore")
+      self._placement = None
+    self._workers = {}
+    self._pool_stale += [ c for k,c in self._pool ]
+    self._pool = []
 
-  # Create a container. Returns the container ID on success, None otherwise.
-  def _create_container(self):
+  # Open or close the lifecycle journal according to the configuration. Workers the journal knows as
+  # running are restored from it instead of being inspected, and their CPUs are accounted for.
+  def _journal_setup(self):
+    if bool(self.conf["journal_days"]) == bool(self._journal):
+      return
+    if not self.conf["journal_days"]:
+      self.logctl.info("Not recording the lifecycle of containers anymore")
+      self._journal.close()
+      self._journal = None
+      return
+    path = self._rundir + "/journal.db"
+    try:
+      journal = Journal(path)
+      unfinished = journal.unfinished()
+    except Exception as e:
+      self.logctl.error("Cannot open journal %s, not recording the lifecycle of containers: %s" % (path, e))
+      return
+    self._journal = journal
+    self._journal_restored = set(unfinished)
+    for cid, (started, pid, cpuset, cpus) in unfinished.iteritems():
+      if started is None or cid in self._workers:
+        continue
+      self._workers[cid] = { "started": started, "pid": pid or 0 }
+      if self._placement and cpuset:
+        self._placement.adopt(cid, cpuset, cpus or 0)
+    self.logctl.info("Recording the lifecycle of containers in %s, %d running container(s) restored" % \
+                     (path, len([ x for x in unfinished.itervalues() if x[0] is not None ])))
+    self._prune_journal()
+
+  # Forget the containers finished more than journal_days ago.
+  def _prune_journal(self):
+    try:
+      n = self._journal.prune(time.time() - self.conf["journal_days"] * 86400)
+    except Exception as e:
+      self.logctl.error("Cannot prune journal: %s", e)
+      return
+    if n:
+      self.logctl.debug("Forgot %d container(s) from the journal", n)
+
+  # Record a lifecycle transition of a worker (a Journal method and its arguments), if journaling.
+  def _record(self, transition, *args, **kwargs):
+    if not self._journal:
+      return
+    try:
+      getattr(self._journal, transition)(*args, **kwargs)
+    except Exception as e:
+      self.logctl.error("Cannot record %s container in journal: %s", transition, e)
+
+  # Select the scheduler policy from the configuration. Its state is kept if it does not change.
+  def _scheduler_setup(self):
+    name = self.conf["scheduler"]
+    if name not in policies:
+      self.logctl.error("Unknown scheduler %s, using pi" % name)
+      name = "pi"
+    if not self.scheduler or self.scheduler.name != name:
+      self.logctl.info("Using the %s scheduler" % name)
+      self.scheduler = policies[name]()
+
+  # Check the scheduler decision against the host memory, see memory.admission. Returns the admitted
+  # (spawn, shed), and sends the decision and its reason to monitoring.
+  def _admission_control(self, spawn, shed):
+    mems = [ u["mem"] for u in self.worker_usage.itervalues() if u.get("mem") ]
+    per_dock = max(sum(mems) / len(mems) if mems else self.conf["max_dock_mem"], 1048576)
+    self._memory.sample()
+    admitted, shed, decision, reason = admission(self._memory, spawn, shed, self.conf, per_dock)
+    self.admission = (decision, reason)
+    if decision == "shed":
+      self.logctl.warning("Killing %d container(s): %s", shed, reason)
+    elif decision != "accept":
+      self.logctl.info("Launching %d container(s) out of %d: %s", admitted, spawn, reason)
+    fields = { "reason": reason, "spawn": admitted, "shed": shed,
+               "mem_pressure_some": self._memory.some, "mem_pressure_full": self._memory.full }
+    if self._memory.total:
+      fields.update(mem_available=self._memory.available, mem_available_pct=self._memory.available_pct())
+    self._stream(series="admission",
+                 tags={ "hostname": self._hostname,
+                        "decision": decision },
+                 fields=fields)
+    return admitted, shed
+
+  # Free `num` slots of cpus_per_dock CPUs at once. Containers are taken from the pools most above
+  # their share, and within a pool they are chosen by the `victims` policy, or by `policy` if given.
+  def _overhead_control(self, num, policy=None):
+    if num < 1:
+      return
+    policy = policy or self.conf["victims"]
+    if policy not in victims:
+      self.logctl.error("Unknown victims policy %s, killing youngest containers", policy)
+      policy = "youngest"
+    running = dict([ (pool, victims[policy](conts, self.worker_usage))
+                     for pool, conts in self._pool_workers().iteritems() ])
+    cont_list = pick_victims(running, self._capacity(), num * self.conf["cpus_per_dock"],
+                             self.conf["cpus_per_dock"], self.conf["kills_per_loop"])
+    if not cont_list:
+      self.logctl.debug('No workers found, nothing to do')
+      return
+    self.logctl.info("Killing %d container(s), %s first", len(cont_list), policy)
+    def remove(c):
+      self.logctl.debug("Killing container %s", c["Id"])
+      try:
+        self.container_remove(c["Id"], force=True)
+      except Exception as e:
+        self.logctl.error("Cannot remove %s: %s", c["Id"], e)
+        return False
+      self.logctl.info('Container %s removed successfully' % c["Id"])
+      self._record("finished", c["Id"], "memory" if self.admission[0] == "shed" else "scheduler")
+      return True
+    if any(parallel_map(remove, cont_list, self.conf["kill_parallelism"])):
+      self._last_kill_time = time.time()
+
+  # Container definition of a pool, without the hostname which is per container.
+  def _container_spec(self, pool):
+    conf = pool.conf
+    return { "Cmd"        : conf["docker_cmd"],
+             "Image"      : self._image_id(pool),
+             "User"       : conf["user_group"],
+             "HostConfig" : { "CpuQuota"    : int(conf["cpus_per_dock"]*100000.),
+                              "CpuPeriod"   : 100000,
+                              "NetworkMode" : "bridge",
+                              "SecurityOpt" : conf["security_opts"] if apparmor_enabled() else [],
+                              "Binds"       : [ x+":rw,shared,Z" for x in conf["binds"] ],
+                              "Memory"      : conf["max_dock_mem"],
+                              "MemorySwap"  : conf["max_dock_mem"] + conf["max_dock_swap"],
+                              "Privileged"  : conf["docker_privileged"],
+                              "Devices"     : [ dict(zip([ "PathOnHost", "PathInContainer",
+                                                           "CgroupPermissions" ], x.split(":", 2)))
+                                                for x in conf["devices"] ],
+                              "CapAdd"      : [ x.lstrip("+") for x in conf["capabilities"] if x and x[0]!="-" ],
+                              "CapDrop"     : [ x.lstrip("-") for x in conf["capabilities"] if x and x[0]=="-" ]
+                            }
+           }
+
+  # Key of the pooled containers that can be started for a pool: its name and container definition.
+  def _spec_key(self, pool, spec):
+    return pool.name + ":" + json.dumps(spec, sort_keys=True)
+
+  # Create a container of a pool. Returns the container ID on success, None otherwise. A `pooled`
+  # container not finding free CPUs is not worth a warning: the warm pool waits for room.
+  def _create_container(self, pool, spec=None, pooled=False):
     uuid = ''.join(random.SystemRandom().choice(string.digits + string.ascii_lowercase) for _ in range(6))
-    cname = self._container_prefix + '-' + uuid
-    c = { "Cmd"        : self.conf["docker_cmd"],
-          "Image"      : self.conf["docker_image"],
-          "Hostname"   : "plancton-%s-%s" % (self._hostname[:40], uuid),
-          "User"       : self.conf["user_group"],
-          "HostConfig" : { "CpuQuota"    : int(self.conf["cpus_per_dock"]*100000.),
-                           "CpuPeriod"   : 100000,
-                           "NetworkMode" : "bridge",
-                           "SecurityOpt" : self.conf["security_opts"] if apparmor_enabled() else [],
-                           "Binds"       : [ x+":rw,shared,Z" for x in self.conf["binds"] ],
-                           "Memory"      : self.conf["max_dock_mem"],
-                           "MemorySwap"  : self.conf["max_dock_mem"] + self.conf["max_dock_swap"],
-                           "Privileged"  : self.conf["docker_privileged"],
-                           "Devices"     : [ dict(zip([ "PathOnHost", "PathInContainer",
-                                                        "CgroupPermissions" ], x.split(":", 2)))
-                                             for x in self.conf["devices"] ],
-                           "CapAdd"      : [ x.lstrip("+") for x in self.conf["capabilities"] if x and x[0]!="-" ],
-                           "CapDrop"     : [ x.lstrip("-") for x in self.conf["capabilities"] if x and x[0]=="-" ]
-                         }
-        }
-    self.logctl.debug("Container definition for %s:\n%s" % (cname, json.dumps(c, indent=2)))
+    cname = pool.prefix + '-' + uuid
+    spec = spec or self._container_spec(pool)
+    config = hashlib.sha1(json.dumps(spec, sort_keys=True)).hexdigest()[:12]
+    c = dict(spec, Hostname="plancton-%s-%s" % (self._hostname[:40], uuid),
+             Labels={ OWNER_LABEL       : self._container_prefix,
+                      "plancton.instance": self._instance or "",
+                      "plancton.pool"    : pool.name,
+                      "plancton.created" : str(int(time.time())),
+                      "plancton.config"  : config })
+    if self._placement:
+      cpuset = self._placement.allocate(cname, pool.cpus)
+      if not cpuset:
+        (self.logctl.debug if pooled else self.logctl.warning)("No free CPUs to place a container of pool %s",
+                                                                pool.name)
+        return None
+      c["HostConfig"] = dict(c["HostConfig"], CpusetCpus=cpuset[0])
+      if cpuset[1]:
+        c["HostConfig"]["CpusetMems"] = cpuset[1]
+    self.logctl.debug("Container definition for %s:\n%s", cname, Deferred(json.dumps, c, indent=2))
     try:
-      return self.container_create_from_conf(jsonconf=c, name=cname)
+      container = self.container_create_from_conf(jsonconf=c, name=cname)
     except Exception as e:
       self.logctl.error("Cannot create container: %s", e)
+      if self._placement:
+        self._placement.release(cname)
       return None
+    if self._placement:
+      self._placement.rename(cname, container["Id"])
+    self._record("created", container["Id"], cname, pool.name, config)
+    return container
 
   # Start a created container. Return PID it if the container is actually running.
   def _start_container(self, container):
     if container is None:
       return None
-    self.logctl.debug("Starting %s" % str(container["Id"]))
+    self.logctl.debug("Starting %s", container["Id"])
     try:
       self.container_start(id=container["Id"])
     except Exception as e:
@@ -300,107 +804,342 @@ class Plancton(Daemon):
       jj = self.container_inspect(id=container["Id"])
       pid = int(jj["State"]["Pid"])
       if pid:
+        self._track_worker(container["Id"], jj)
         return pid
     except Exception as e:
       self.logctl.error(e)
     return None
 
-  # Pretty print the statuses of controlled containers.
-  def _dump_container_list(self):
-    status_table = PrettyTable(['n\'', 'docker hash', 'status', 'docker name', '   pid   '])
-    status_table.align["   pid   "] = "r"
+  # Remember start time and PID of a running worker, so that it does not need to be inspected again,
+  # here and in the journal.
+  def _track_worker(self, cid, insdata):
+    self._workers[cid] = { "started": docker_time(insdata["State"]["StartedAt"]),
+                           "pid": int(insdata["State"].get("Pid", 0)) }
+    hc = insdata.get("HostConfig") or {}
+    cpus = float(hc.get("CpuQuota") or 0) / (hc.get("CpuPeriod") or 100000)
+    if self._placement and hc.get("CpusetCpus"):
+      self._placement.adopt(cid, hc["CpusetCpus"], cpus)
+    name = "/" + insdata.get("Name", "").lstrip("/")
+    self._record("started", cid, name[1:], self._pool_name({ "Names": [ name ] }),
+                 self._workers[cid]["started"], self._workers[cid]["pid"], hc.get("CpusetCpus"), cpus)
+
+  # Inspect containers with a bounded number of concurrent requests. Return a dict id -> data,
+  # without the containers which could not be inspected.
+  def _inspect_containers(self, ids):
+    def inspect(cid):
+      try:
+        return self.container_inspect(cid)
+      except Exception as e:
+        self.logctl.error("Couldn't get container information! %s", e)
+    return dict([ x for x in zip(ids, parallel_map(inspect, ids, self.conf["inspect_parallelism"])) if x[1] ])
+
+  # Launch containers concurrently, as many of each pool as given by `plan` (pool -> count), starting
+  # pooled ones first. Return how many of them are running.
+  def _launch_containers(self, plan):
+    jobs = []
+    for pool, num in plan.iteritems():
+      spec = self._container_spec(pool)
+      jobs += [ (pool, spec, self._spec_key(pool, spec)) ] * num
+    pids = parallel_map(lambda (pool, spec, key): self._start_container(self._take_pooled(key) or \
+                                                                        self._create_container(pool, spec)),
+                        jobs, self.conf["launch_parallelism"])
+    started = len([ x for x in pids if x ])
+    if started < len(jobs):
+      self.logctl.warning("Launched %d container(s) out of %d", started, len(jobs))
+    return started
+
+  # Take a pooled container created with the given key, None if there is none.
+  def _take_pooled(self, key):
+    with self._pool_lock:
+      for i, (k, c) in enumerate(self._pool):
+        if k == key:
+          del self._pool[i]
+          return c
+    return None
+
+  # Keep `warm_pool` containers created from the current spec of each pool, ready to be started, so
+  # that filling a slot is only a start. Pooled containers created from another spec (image or
+  # configuration changed), or all of them when `enabled` is False, are removed.
+  def _fill_pool(self, enabled=True):
+    size = self.conf["warm_pool"] if enabled else 0
+    specs = dict([ (pool, self._container_spec(pool)) for pool in self.pools
+                   if pool.weight and self._image_id(pool) ])
+    keys = dict([ (pool, self._spec_key(pool, spec)) for pool, spec in specs.iteritems() ])
     try:
-      clist = self.container_list(all=True)
+      snap = self._containers()
     except Exception as e:
-      self.logctl.error("Couldn't get container list: %s", e)
+      self.logctl.error("Couldn't get containers list, not filling the pool: %s", e)
       return
-    num = 0
-    for c in clist:
-      if c.get("Names", [""])[0][1:].startswith(self._container_prefix):
-        num = num+1
-        shortid = c['Id'][:12]
-        status = c['Status'].lower()
-        name = c['Names'][0][1:]
+    pool = [ x for x in self._pool if x[1]["Id"] in snap.by_id ]
+    stale = self._pool_stale + [ c for k,c in pool if k not in keys.values() ]
+    self._pool = []
+    for key in keys.itervalues():
+      self._pool += [ x for x in pool if x[0] == key ][:size]
+      stale += [ c for k,c in pool if k == key ][size:]
+    self._pool_stale = []
+    if stale:
+      self.logctl.info("Removing %d pooled container(s) not needed anymore", len(stale))
+      def remove(c):
         try:
-          pid = self.container_inspect(id=c['Id'])['State'].get('Pid', 0)
+          self.container_remove(c["Id"], force=True)
         except Exception as e:
-          self.logctl.warning("While inspecting container %s: %s" % (shortid, e))
-          continue
-        pid = "" if pid == 0 else str(pid)
-        status_table.add_row([num, shortid, status, name, pid])
-    self.logctl.info('Container list:\n' + str(status_table))
-
-  # Return the number of running containers.
-  def _count_containers(self):
+          self.logctl.warning("Cannot remove pooled container %s: %s", c["Id"], e)
+        else:
+          self._record("finished", c["Id"], "unused")
+      parallel_map(remove, stale, self.conf["kill_parallelism"])
+    missing = []
+    for pool, key in keys.iteritems():
+      num = size - len([ x for x in self._pool if x[0] == key ])
+      if num > 0 and self._placement and not self._placement.fits(pool.cpus):
+        self.logctl.debug("No free CPUs to keep pooled containers of pool %s", pool.name)
+        continue
+      missing += [ pool ] * num
+    if missing:
+      created = parallel_map(lambda pool: (keys[pool], self._create_container(pool, specs[pool], pooled=True)),
+                             missing, self.conf["launch_parallelism"])
+      self._pool += [ x for x in created if x[1] ]
+      self.logctl.debug("Pooled containers: %d/%d", len(self._pool), size*len(keys))
+
+  # Image ID the containers of a pool are created from, None if not available yet.
+  def _image_id(self, pool):
+    updater = self._images.get(pool.conf["docker_image"])
+    return updater.current[1] if updater and updater.current else None
+
+  # Name of the pool of a container, "none" if it belongs to no pool.
+  def _pool_name(self, c):
+    pool = pool_of(self.pools, c)
+    return pool.name if pool else "none"
+
+  # Running workers of each pool, youngest first. Workers of no pool (left by a previous configuration)
+  # are under None.
+  def _pool_workers(self):
+    workers = dict([ (pool, []) for pool in self.pools ])
+    for c in self._filtered_list(name=self._container_prefix):
+      workers.setdefault(pool_of(self.pools, c), []).append(c)
+    return workers
+
+  # CPUs and memory used by the running workers of each pool.
+  def _pool_usage(self, workers):
+    return dict([ (pool, (len(conts)*pool.cpus, len(conts)*pool.mem)) for pool, conts in workers.iteritems() if pool ])
+
+  # CPUs and memory the pools share: max_docks slots of the global container shape.
+  def _capacity(self):
+    return (float(self.conf["max_docks"] * self.conf["cpus_per_dock"]),
+            float(self.conf["max_docks"] * self.conf["max_dock_mem"]))
+
+  # Running workers counted in slots of cpus_per_dock CPUs, as seen by the scheduler.
+  def _count_slots(self, workers):
+    cpus = sum([ len(conts) * (pool.cpus if pool else self.conf["cpus_per_dock"])
+                 for pool, conts in workers.iteritems() ])
+    return int(round(cpus / self.conf["cpus_per_dock"]))
+
+  # Containers of each pool to launch for `spawn` more slots: the pools share the capacity by weight,
+  # and containers are packed into the free CPU and memory (see pools.py). Only pools whose image is
+  # available get containers. CPUs granted to a pool waiting for room for its container are kept for
+  # the next loops, until it fits, or until the scheduler grants nothing.
+  def _plan_launches(self, spawn, workers):
+    capacity = self._capacity()
+    used = self._pool_usage(workers)
+    orphans = len(workers.get(None, []))
+    free_cpus = capacity[0] - sum([ u[0] for u in used.values() ]) - orphans*self.conf["cpus_per_dock"]
+    free_mem = capacity[1] - sum([ u[1] for u in used.values() ]) - orphans*self.conf["max_dock_mem"]
+    granted = min(spawn * self.conf["cpus_per_dock"] + self._launch_credit, free_cpus) if spawn else 0.
+    self._launch_credit = 0.
+    if granted <= 0:
+      return {}
+    plan, waiting = allocate([ pool for pool in self.pools if self._image_id(pool) ], used, capacity,
+                             (granted, free_mem), self.conf["docks_per_loop"])
+    if waiting:
+      self._launch_credit = max(granted - sum([ pool.cpus * n for pool, n in plan.iteritems() ]), 0.)
+      self.logctl.debug("Pool %s waits for %g free CPU(s), %g granted so far",
+                        waiting.name, waiting.cpus, self._launch_credit)
+    if len(self.pools) > 1:
+      self.logctl.debug("Containers to launch per pool: %s",
+                        ", ".join([ "%s %d" % (pool.name, plan.get(pool, 0)) for pool in self.pools ]))
+    return plan
+
+  # Send the resources used by each pool to monitoring.
+  def _report_pools(self, workers):
+    capacity = self._capacity()
+    used = self._pool_usage(workers)
+    for pool in self.pools:
+      self._stream(series="pool",
+                   tags={ "hostname": self._hostname,
+                          "pool": pool.name },
+                   fields={ "containers": len(workers.get(pool, [])),
+                            "cpus": used[pool][0],
+                            "mem": used[pool][1],
+                            "weight": pool.weight,
+                            "image": pool.conf["docker_image"],
+                            "ready": bool(self._image_id(pool)),
+                            "share": used[pool][0] / capacity[0] if capacity[0] else 0. })
+    if self._placement:
+      for node, cpus in self._placement.usage().iteritems():
+        self._stream(series="placement",
+                     tags={ "hostname": self._hostname,
+                            "node": node },
+                     fields={ "cpus": len(self._placement.topology.nodes[node]),
+                              "used": cpus })
+
+  # Pretty print the statuses of controlled containers when they, their states or PIDs changed, or at
+  # least every dump_interval seconds. The table is built by the log thread.
+  def _dump_container_list(self):
     try:
-      clist = self.container_list(all=False)
+      clist = self._containers().with_prefix(self._container_prefix)
     except Exception as e:
-      self.logctl.error("Couldn't get containers list, defaulting running value to zero: %s", e)
-      return 0
-    return len([ x for x in clist if x.get("Status", "").startswith("Up")
-                   and x.get("Names", [""])[0][1:].startswith(self._container_prefix) ])
+      self.logctl.error("Couldn't get container list: %s", e)
+      return
+    rows = [ (c['Id'], container_state(c), c['Status'].lower(), container_name(c),
+              self._workers.get(c['Id'], {}).get('pid', 0)) for c in clist ]
+    key = [ (r[0], r[1], r[4]) for r in rows ]
+    now = time.time()
+    if key == self._dumped[0] and now - self._dumped[1] < self.conf["dump_interval"]:
+      return
+    self._dumped = (key, now)
+    self.logctl.info('Container list:\n%s', Deferred(container_table, rows))
+
+  # Log the phases of the tick started at epoch `start` (phases not run in it are left out), and send
+  # the rolling timing statistics to monitoring.
+  def _report_timings(self, start):
+    phases = self.timings.last("tick", since=start)
+    self.logctl.debug("Tick took %.1f ms: %s", phases.pop("tick") * 1000,
+                      Deferred(lambda: ", ".join([ "%s %.1f" % (k[5:], v*1000) for k, v in sorted(phases.items()) ])))
+    for name, stats in self.timings.summary().iteritems():
+      self._stream(series="daemon_timing",
+                   tags={ "hostname": self._hostname,
+                          "name": name },
+                   fields=stats)
+
+  # Report rolling timing statistics obtained from the running daemon.
+  def timing(self):
+    try:
+      reply = control_request(self._ctlsock, "timing")
+    except Exception as e:
+      self.logctl.error("Cannot get timings from %s: %s" % (self._ctlsock, e))
+      return False
+    table = PrettyTable([ "name", "count", "p50 ms", "p95 ms", "p99 ms", "max ms", "last ms" ])
+    table.align["name"] = "l"
+    for name in sorted(reply):
+      if name == "ok":
+        continue
+      st = reply[name]
+      table.add_row([ name, st["count" ] ] + [ "%.1f" % (st[k]*1000) for k in [ "p50", "p95", "p99", "max", "last" ] ])
+    self.logctl.info("Timings:\n" + str(table))
+    return True
+
+  # Workers history of the last 24 hours from the journal, for the control socket.
+  def _history(self):
+    if not self._journal:
+      raise Exception("no journal, set journal_days to record the lifecycle of containers")
+    return self._journal.history(time.time() - 86400)
+
+  # Report the workers history of the last 24 hours obtained from the running daemon.
+  def history(self):
+    try:
+      reply = control_request(self._ctlsock, "history")
+    except Exception as e:
+      self.logctl.error("Cannot get history from %s: %s" % (self._ctlsock, e))
+      return False
+    if not reply.get("ok"):
+      self.logctl.error("Cannot get history: %s" % reply.get("error"))
+      return False
+    uptime = lambda x: "" if x is None else "%.0f" % x
+    table = PrettyTable([ "hour (UTC)", "started", "finished", "mean uptime s" ])
+    for hour, h in sorted(reply["hours"].items()):
+      table.add_row([ time.strftime("%Y-%m-%d %H:00", time.gmtime(int(hour))), h["started"], h["finished"],
+                      uptime(h["mean_uptime"]) ])
+    self.logctl.info("Containers per hour:\n" + str(table))
+    table = PrettyTable([ "pool", "finished", "mean uptime s", "reasons" ])
+    table.align["reasons"] = "l"
+    for name, p in sorted(reply["pools"].items()):
+      table.add_row([ name, p["finished"], uptime(p["mean_uptime"]),
+                      ", ".join([ "%s %d" % x for x in sorted(p["reasons"].items()) ]) ])
+    self.logctl.info("Containers per pool:\n" + str(table))
+    self.logctl.info("%d container(s) finished, mean uptime %s s" % (reply["finished"], uptime(reply["mean_uptime"])))
+    return True
+
+  # Report how many container list calls the shared snapshot saved in this tick.
+  def _report_list_calls(self):
+    self.logctl.debug("Containers listed %d time(s) this tick, %d Docker API call(s) saved",
+                      self._list_calls, self._list_saved)
+    self._stream(series="daemon",
+                 tags={ "hostname": self._hostname },
+                 fields={ "list_calls": self._list_calls,
+                          "api_calls_saved": self._list_saved })
 
   # Clean up dead or stale containers.
   def _control_containers(self):
     try:
-      clist = self.container_list(all=True)
+      snap = self._containers()
     except Exception as e:
       self.logctl.error("Couldn't get containers list: %s", e)
       return
-    for i in clist:
-      if not i.get("Names", [""])[0][1:].startswith(self._container_prefix):
-        self.logctl.debug("Ignoring container %s", i.get("Names", [""])[0][1:])
+    # Workers not launched by this instance are inspected once; exited ones to get their uptime
+    workers = snap.with_prefix(self._container_prefix)
+    pooled = set([ c["Id"] for k,c in self._pool ])
+    for cid,insdata in self._inspect_containers([ c["Id"] for c in workers if c["Id"] not in self._workers
+                                                  and container_state(c) == "running" ]).iteritems():
+      self._track_worker(cid, insdata)
+    exited = self._inspect_containers([ c["Id"] for c in workers if container_state(c) == "exited" ])
+    for cid in self._workers.keys():
+      if cid not in snap.by_id:
+        del self._workers[cid]
+        self._record("finished", cid, "vanished")
+    for cid in self._journal_restored - set(snap.by_id):
+      self._record("finished", cid, "vanished")
+    self._journal_restored = set()
+    for cid in (self._placement.held.keys() if self._placement else []):
+      if cid not in snap.by_id:
+        self._placement.release(cid)
+    for i in snap.containers:
+      if not container_name(i).startswith(self._container_prefix):
+        self.logctl.debug("Ignoring container %s", container_name(i))
         continue
       to_remove = False
+      state = container_state(i)
+      reason, uptime, finished = state, None, None
+      if state == "created" and i["Id"] in pooled:
+        continue
       # TTL threshold block
-      if "running" in i['State']:
-        try:
-          insdata = self.container_inspect(i["Id"])
-        except Exception as e:
-          self.logctl.error("Couldn't get container information! %s", e)
-        else:
-          statobj = datetime.strptime(insdata['State']['StartedAt'][:19], "%Y-%m-%dT%H:%M:%S")
-          dock_uptime = utc_time() - time.mktime(statobj.timetuple())
-          if dock_uptime > self.conf["max_ttl"] or self._force_kill:
-            if self._force_kill:
-              self.logctl.info("Force killing %s" if self._force_kill else \
-                               "Killing %s since it exceeded the max TTL", i['Id'])
-            for streamer in self.streamers:
-              streamer(series="container",
+      if state == "running":
+        dock_uptime = time.time() - self._workers.get(i["Id"], {}).get("started", i["Created"])
+        if dock_uptime > self.conf["max_ttl"] or self._force_kill:
+          if self._force_kill:
+            self.logctl.info("Force killing %s" if self._force_kill else \
+                             "Killing %s since it exceeded the max TTL", i['Id'])
+          self._stream(series="container",
                        tags={ "hostname": self._hostname,
+                              "pool": self._pool_name(i),
                               "started": True,
                               "killed": True },
                        fields={ "uptime": dock_uptime })
-            to_remove = True
-          else:
-            self.logctl.debug("Container %s is below its maximum TTL, leaving it alone", i["Id"])
+          to_remove = True
+          reason, uptime = "force-stop" if self._force_kill else "ttl", dock_uptime
+        else:
+          self.logctl.debug("Container %s is below its maximum TTL, leaving it alone", i["Id"])
       else:
         # Bad status block
         self.logctl.info("Killing non-running container %s (status is %s)", i["Id"], i["Status"])
-        if "exited" in i["State"]:
+        if i["Id"] in exited:
           # Container has terminated
-          try:
-            insdata = self.container_inspect(i["Id"])
-          except Exception as e:
-            self.logctl.error("Couldn't get container information! %s", e)
-          else:
-            statobj_start = datetime.strptime(insdata['State']['StartedAt'][:19], "%Y-%m-%dT%H:%M:%S")
-            statobj_end = datetime.strptime(insdata['State']['FinishedAt'][:19], "%Y-%m-%dT%H:%M:%S")
-            dock_uptime = time.mktime(statobj_end.timetuple()) - time.mktime(statobj_start.timetuple())
-            for streamer in self.streamers:
-              streamer(series="container",
+          insdata = exited[i["Id"]]
+          dock_uptime = docker_time(insdata['State']['FinishedAt']) - docker_time(insdata['State']['StartedAt'])
+          uptime, finished = dock_uptime, docker_time(insdata['State']['FinishedAt'])
+          self._stream(series="container",
                        tags={ "hostname": self._hostname,
+                              "pool": self._pool_name(i),
                               "started": True,
                               "killed": False },
                        fields={"uptime": dock_uptime})
-        if "created" in i["State"]:
+        if state == "created":
           # Container has never had any chance to start :-(
-          for streamer in self.streamers:
-            streamer(series="container",
-                     tags={ "hostname": self._hostname,
-                            "started": False,
-                            "killed": False },
-                     fields={ "uptime": 0 })
+          self._stream(series="container",
+                       tags={ "hostname": self._hostname,
+                              "pool": self._pool_name(i),
+                              "started": False,
+                              "killed": False },
+                       fields={ "uptime": 0 })
+          reason = "not started"
         to_remove = True
 
       if to_remove:
@@ -410,16 +1149,60 @@ class Plancton(Daemon):
           self.logctl.warning('It was not possible to remove container with id %s: %s', i['Id'], e)
         else:
           self.logctl.info("Removed container %s", i["Id"])
-        self._last_kill_time = time.time()
+          self._record("finished", i["Id"], reason, uptime=uptime, when=finished)
+        if state != "exited":
+          self._last_kill_time = time.time()
     if self._force_kill:
       self._force_kill = False
       try:
         os.remove(self._fstopfile)
       except OSError as e:
         if e.errno != errno.ENOENT:
-          self.logctl.error("Cannot remove force-stop status file %s: %s" % (self._fstopfile, e))
+          self.logctl.error("Cannot remove force-stop status file %s: %s", self._fstopfile, e)
+
+  # Send a command to the running daemon through its control socket. Returns True or False if the
+  # daemon answered, None if it could not be reached: marker files are then used instead.
+  def _send_control(self, command):
+    if not os.path.exists(self._ctlsock):
+      return None
+    try:
+      reply = control_request(self._ctlsock, command)
+    except Exception as e:
+      self.logctl.warning("Cannot reach the daemon on %s, using status files: %s" % (self._ctlsock, e))
+      return None
+    if not reply.get("ok"):
+      self.logctl.error("Command %s failed: %s" % (command, reply.get("error")))
+      return False
+    self.logctl.info("Command %s done, daemon is now %s" % (command, reply.get("mode")))
+    return True
 
   def drain(self, stop=False):
+    r = self._send_control("drain-stop" if stop else "drain")
+    return self._mark_drain(stop) if r is None else r
+
+  def resume(self):
+    r = self._send_control("resume")
+    return self._mark_resume() if r is None else r
+
+  def kill(self):
+    r = self._send_control("force-stop")
+    return self._mark_kill() if r is None else r
+
+  # Report the live daemon state obtained from the control socket, if running.
+  def status(self):
+    if not super(Plancton, self).status():
+      return False
+    try:
+      st = control_request(self._ctlsock, "status")
+    except Exception as e:
+      self.logctl.warning("No live status from %s: %s" % (self._ctlsock, e))
+      return True
+    for k in sorted(st):
+      if k != "ok":
+        self.logctl.info("%-20s %s" % (k+":", json.dumps(st[k]) if isinstance(st[k], dict) else st[k]))
+    return True
+
+  def _mark_drain(self, stop=False):
     try:
       os.open(self._drainfile, os.O_CREAT|os.O_EXCL, 0644)
       if stop:
@@ -433,15 +1216,17 @@ class Plancton(Daemon):
         return False
     return True
 
-  def resume(self):
+  def _mark_resume(self):
     self.logctl.info("Exiting drain mode: new containers will be started")
     try:
       os.remove(self._drainfile)
     except OSError as e:
       if e.errno != errno.ENOENT:
         self.logctl.warning("Cannot remove drain status file %s: %s" % (self._drainfile, e))
+        return False
+    return True
 
-  def kill(self):
+  def _mark_kill(self):
     self.logctl.info("Force-stop mode requested: not starting new containers and killing running ones")
     try:
       os.open(self._fstopfile, os.O_CREAT|os.O_EXCL, 0644)
@@ -451,8 +1236,70 @@ class Plancton(Daemon):
         return False
     return True
 
+  # Serve the control socket. Mode changes still go through the marker files, so that they survive
+  # restarts, and wake the main loop up to be applied at once.
+  def _control_setup(self):
+    def mode(mark):
+      def command():
+        if not mark():
+          raise Exception("cannot update status files in %s" % self._rundir)
+        self._force_kill = os.path.isfile(self._fstopfile)
+        self._wakeup.set()
+        return self._status()
+      return command
+    def stop():
+      self.onexit()
+      self._wakeup.set()
+      return self._status()
+    self._control = ControlServer(self._ctlsock, { "drain"      : mode(self._mark_drain),
+                                                   "drain-stop" : mode(lambda: self._mark_drain(stop=True)),
+                                                   "resume"     : mode(self._mark_resume),
+                                                   "force-stop" : mode(self._mark_kill),
+                                                   "stop"       : stop,
+                                                   "status"     : self._status,
+                                                   "timing"     : self.timings.summary,
+                                                   "history"    : self._history })
+    try:
+      self._control.start()
+    except Exception as e:
+      self.logctl.error("Cannot listen on %s, only status files will work: %s" % (self._ctlsock, e))
+      self._control = None
+
+  # Live daemon state, built without calling Docker.
+  def _status(self):
+    return { "pid"                : os.getpid(),
+             "version"            : self.__version__,
+             "uptime"             : int(time.time() - self._start_time),
+             "mode"               : "exiting" if not self._do_main_loop else \
+                                    "force-stopping" if self._force_kill else \
+                                    "draining" if os.path.isfile(self._drainfile) else "active",
+             "containers"         : self._running,
+             "max_containers"     : self.conf["max_docks"],
+             "idle_containers"    : self.idle_workers,
+             "cpu_efficiency"     : self.efficiency,
+             "cpu_pressure"       : self.cpu_pressure,
+             "cpu_per_cpu"        : [ round(x, 1) for x in self._cpuload.per_cpu ],
+             "cpu_last_10m"       : dict(zip([ "mean", "max" ], self._cpuload.recent(600))),
+             "mem_available"      : self._memory.available,
+             "mem_pressure"       : self._memory.some,
+             "admission"          : dict(zip([ "decision", "reason" ], self.admission)),
+             "scheduler"          : self.scheduler.name if self.scheduler else None,
+             "scheduler_state"    : self.scheduler.metrics() if self.scheduler else {},
+             "last_tick"          : self._tick_start,
+             "last_tick_duration" : self._tick_duration,
+             "docker"             : self.docker_breaker.state,
+             "pools"              : dict([ (pool.name, { "image": self._images[pool.conf["docker_image"]].current \
+                                                              if pool.conf["docker_image"] in self._images else None,
+                                                      "weight": pool.weight })
+                                             for pool in self.pools ]),
+             "warm_pool"          : len(self._pool),
+             "placement"          : self._placement.usage() if self._placement else None,
+             "journal"            : self._journal.path if self._journal else None,
+             "events"             : bool(self._events and self._events.connected) }
+
+  # Called from the exit signal handler, possibly while the main thread holds a lock (logging, streamers,
+  # events): only ask the main loop to stop, it notices within a second.
   def onexit(self):
-    self.logctl.info("Graceful termination requested: will exit gracefully soon")
     self._do_main_loop = False
 
   def init(self):
@@ -460,6 +1307,7 @@ class Plancton(Daemon):
     logging.getLogger("docker").setLevel(logging.WARNING)
     self._setup_log_files()
     self.logctl.info("---- plancton v%s running with pid %d ----" % (self.__version__, os.getpid()))
+    self._instance = "%s:%d:%d" % (self._hostname, os.getpid(), self._start_time)
     try:
       os.remove(self._fstopfile)
     except OSError as e:
@@ -469,74 +1317,133 @@ class Plancton(Daemon):
     else:
       os.chmod(self._rundir, 0700)
     self._read_conf()
+    self._log_format_setup()
+    self._control_setup()
     self._influxdb_setup()
-    try:
-      self.docker_pull(*self.conf["docker_image"].split(":", 1))
-      self._has_image = True
-    except Exception as e:
-      self.logctl.error("Cannot pull Docker image %s during init: will retry later" % self.conf["docker_image"])
+    self._metrics_setup()
+    self._events_setup()
+    self._scheduler_setup()
+    self._placement_setup()
+    self._journal_setup()
+    self._refresh_image()
     self._control_containers()
 
+  # Pull an image. docker-py reports pull errors in the output instead of raising.
+  def _pull_image(self, name):
+    for line in self.docker_pull(*split_image(name)).splitlines():
+      try:
+        err = json.loads(line).get("error")
+      except ValueError:
+        continue
+      if err:
+        raise docker.errors.DockerException(err)
+
+  # Refresh the image in the background when it is missing, changed, or expired. Expiration is
+  # randomized so that hosts sharing a configuration do not all query the registry at once.
+  def _refresh_image(self):
+    now = time.time()
+    names = set([ pool.conf["docker_image"] for pool in self.pools if pool.weight ])
+    for name in set(self._images) - names:
+      del self._images[name]
+      self._image_refresh_at.pop(name, None)
+    for name in sorted(names):
+      if name not in self._images:
+        self._images[name] = ImageUpdater(inspect=self.image_inspect,
+                                          remote_digest=self.image_registry_digest,
+                                          pull=self._pull_image,
+                                          on_ready=lambda name, image_id: self._wakeup.set())
+      if self._images[name].current and now < self._image_refresh_at.get(name, 0):
+        continue
+      if self._images[name].refresh(name):
+        jitter = self.conf["image_jitter"]
+        self._image_refresh_at[name] = now + self.conf["image_expiration"] * random.uniform(1-jitter, 1+jitter)
+
   # Main loop, do comparison between uptime and thresholds sets for updates.
   def main_loop(self):
+    exited, self._exited = self._exited, set()  # before listing: exits after it are for the next loop
+    self._snapshot = None
+    self._list_calls = self._list_saved = 0
     self._set_cpu_efficiency()
     now = time.time()
-    for streamer in self.streamers:
-      streamer(series="daemon",
-               tags={ "hostname": self._hostname },
-               fields={ "uptime": now - self._start_time })
+    self._stream(series="daemon",
+                 tags={ "hostname": self._hostname },
+                 fields={ "uptime": now - self._start_time })
     delta_config = now - self._last_confup_time
-    delta_update = now - self._last_update_time
     draining = os.path.isfile(self._drainfile)
     if draining:
-      self.logctl.info("Drain status file %s found: no new containers will be started" % self._drainfile)
+      self.logctl.info("Drain status file %s found: no new containers will be started", self._drainfile)
     if self._force_kill:
-      self.logctl.info("Force kill file %s found: not starting containers, killing existing" % self._fstopfile)
-    self._overhead_control()
-    prev_img = self.conf["docker_image"]
-    prev_influxdb_url = self.conf["influxdb_url"]
-    if delta_config >= int(self.conf["updateconfig"]):
-      self._read_conf()
-      self._last_confup_time = time.time()
-    if not self._has_image or prev_img != self.conf["docker_image"] or delta_update >= int(self.conf["image_expiration"]):
-      self._has_image = False
-      try:
-        self.docker_pull(*self.conf["docker_image"].split(":", 1))
-        self._has_image = True
-        self._last_update_time = time.time()
-      except Exception as e:
-        self.logctl.error("Cannot pull Docker image %s: no new containers, will retry later" % \
-                          self.conf["docker_image"])
-    if prev_influxdb_url.symmetric_difference(self.conf["influxdb_url"]):
-      self._influxdb_setup()
-    running = self._count_containers()
-    self.logctl.debug("CPU used: %.2f%%, available: %.2f%%" % (self.efficiency, self.idle))
-    for streamer in self.streamers:
-      streamer(series="measurement",
-               tags={ "hostname": self._hostname },
-               fields={ "cpu_eff": self.efficiency })
-      streamer(series="daemon",
-               tags={ "hostname": self._hostname },
-               fields={ "containers": running,
-                        "status": "draining" if draining else "active" })
-    fitting_docks = int(self.idle*0.95*self._num_cpus/(self.conf["cpus_per_dock"]*100))
-    launchable_containers = min(fitting_docks,
-                                max(self.conf["max_docks"]-running, 0),
-                                self.conf["docks_per_loop"])
-    self.logctl.debug("Potentially fitting containers based on CPU utilisation: %d", fitting_docks)
-    if self._has_image and not draining and not self._force_kill:
-      if now-self._last_kill_time > self.conf["grace_spawn"]:
-        self.logctl.info("Will launch %d new container(s)" % launchable_containers)
-        for _ in range(launchable_containers):
-          if not self._start_container(self._create_container()):
-            self.logctl.warning("Starting container failed: not attempting to launch other containers this time")
-            break
-      elif launchable_containers > 0:
-        self.logctl.info("Not launching %d containers: too little time since last kill" % \
-                         launchable_containers)
-    self._control_containers()
-    self._last_update_time = time.time()
-    self._dump_container_list()
+      self.logctl.info("Force kill file %s found: not starting containers, killing existing", self._fstopfile)
+    with self.timings.timer("tick.usage"):
+      self._collect_usage()
+    with self.timings.timer("tick.schedule"):
+      running = self._count_slots(self._pool_workers())
+      spawn, shed = self.scheduler.decide(Load(now, self.efficiency, self.idle, running, self._num_cpus,
+                                               self._last_kill_time), self.conf)
+      spawn = self._refill(exited, spawn, shed, running)
+    self._stream(series="scheduler",
+                 tags={ "hostname": self._hostname,
+                        "policy": self.scheduler.name },
+                 fields=dict(self.scheduler.metrics(), spawn=spawn, shed=shed))
+    spawn, shed = self._admission_control(spawn, shed)
+    with self.timings.timer("tick.overhead"):
+      self._overhead_control(shed, policy="most_mem" if self.admission[0] == "shed" else None)
+    with self.timings.timer("tick.config"):
+      changed = self._read_conf()
+      if changed & set([ "influxdb_url", "influxdb_batch", "influxdb_flush" ]):
+        self._influxdb_setup()
+      if changed & set([ "metrics_port", "metrics_bind" ]):
+        self._metrics_setup()
+      if "docker_events" in changed:
+        self._events_setup()
+      if "scheduler" in changed:
+        self._scheduler_setup()
+      if "cpuset" in changed:
+        self._placement_setup()
+      if "journal_days" in changed:
+        self._journal_setup()
+      if "log_format" in changed:
+        self._log_format_setup()
+      if delta_config >= int(self.conf["updateconfig"]):
+        self._update_max_docks()
+        if self._journal:
+          self._prune_journal()
+        self._last_confup_time = time.time()
+    with self.timings.timer("tick.image"):
+      self._refresh_image()
+    workers = self._pool_workers()
+    running = self._running = sum([ len(x) for x in workers.itervalues() ])
+    self._report_pools(workers)
+    self.logctl.debug("CPU used: %.2f%% (last sample %.2f%%, pressure %.2f%%), available: %.2f%%",
+                      self.efficiency, self._cpuload.last or 0, self.cpu_pressure, self.idle)
+    self._stream(series="measurement",
+                 tags={ "hostname": self._hostname },
+                 fields={ "cpu_eff": self.efficiency,
+                          "cpu_last": self._cpuload.last or 0.0,
+                          "cpu_busiest": max(self._cpuload.per_cpu or [ 0.0 ]),
+                          "cpu_pressure": self.cpu_pressure })
+    self._stream(series="daemon",
+                 tags={ "hostname": self._hostname },
+                 fields={ "containers": running,
+                          "status": "waiting" if self.docker_breaker.state != CircuitBreaker.CLOSED else \
+                                    "draining" if draining else "active",
+                          "docker": self.docker_breaker.state,
+                          "idle_containers": self.idle_workers,
+                          "events": bool(self._events and self._events.connected) })
+    if not draining and not self._force_kill:
+      plan = self._plan_launches(spawn, workers)
+      self.logctl.info("Will launch %d new container(s)", sum(plan.values()))
+      with self.timings.timer("tick.launch"):
+        self._launch_containers(plan)
+    with self.timings.timer("tick.control"):
+      self._control_containers()
+    with self.timings.timer("tick.pool"):
+      self._fill_pool(enabled=not draining and not self._force_kill)
+    with self.timings.timer("tick.dump"):
+      self._dump_container_list()
+    self._report_list_calls()
+    self.timings.record("tick", time.time() - now)
+    self._report_timings(now)
     if running == 0 and draining and os.path.isfile(self._drainfile_stop):
       self.logctl.info("Drain-stop requested. No running containers found, will exit.")
       os.remove(self._drainfile_stop)
@@ -548,12 +1455,32 @@ class Plancton(Daemon):
     self.init()
     while self._do_main_loop or self._force_kill:
       count = 0
+      self._wakeup.clear()
+      self._tick_start = time.time()
       self.main_loop()
-      self.logctl.debug("Sleeping %d seconds..." % self.conf["main_sleep"])
+      self._tick_duration = time.time() - self._tick_start
+      self.logctl.debug("Sleeping %d seconds...", self.conf["main_sleep"])
       self._force_kill = os.path.isfile(self._fstopfile)
       while self._do_main_loop and count < self.conf["main_sleep"] and not self._force_kill:
-        time.sleep(1)
+        if self._wakeup.wait(1):
+          self.logctl.debug("Woken up: not waiting for the next loop")
+          break
         count = count+1
+        if count % max(1, int(self.conf["cpu_sampling"])) == 0:
+          self._cpuload.sample()
         self._force_kill = os.path.isfile(self._fstopfile)
+    self.logctl.info("Graceful termination requested: will exit gracefully soon")
+    for streamer in self.streamers:
+      streamer.request_flush()
+    if self._events:
+      self._events.stop()
+    if self._control:
+      self._control.stop()
+    if self._metrics_server:
+      self._metrics_server.stop()
+    self._fill_pool(enabled=False)
+    if self._journal:
+      self._journal.close()
+    self._flush_streamers()
     self.logctl.info("Exiting gracefully")
     return 0
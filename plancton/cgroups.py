@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import os, time, logging
+from glob import glob
+
+# Per-container resource usage read straight from the cgroup filesystem, without the Docker stats API.
+# Both the unified hierarchy (cgroup v2) and the per-controller one (cgroup v1) are supported, with the
+# cgroupfs and systemd cgroup drivers. Only the CPU controller is required: memory and I/O are 0 when
+# their controller is not available. Cgroup directories are looked up once per container. All given
+# containers are read in one pass by `collect`, which returns for each of them:
+#   cpu: CPU cores used since the previous pass (None on first sight)
+#   cpu_time: CPU time used since the container started (s)
+#   mem: memory currently used (bytes)
+#   io:  block I/O rate since the previous pass (bytes/s, None on first sight)
+
+class CgroupCollector(object):
+
+  def __init__(self, root="/sys/fs/cgroup"):
+    self.root = root
+    self.version = 2 if os.path.isfile(root + "/cgroup.controllers") else 1
+    self.logctl = logging.getLogger("cgroups")
+    self.usage = {}
+    self._dirs = {}  # container id -> { controller: cgroup directory }
+    self._last = {}  # container id -> (time, cpu ns, io bytes)
+
+  def available(self):
+    return os.path.isdir(self.root)
+
+  # Cgroup directory of a container for a given controller (v1 only), None if not found.
+  def _find(self, cid, controller=None):
+    base = self.root if self.version == 2 else self.root + "/" + controller
+    for d in [ "%s/system.slice/docker-%s.scope" % (base, cid),
+               "%s/docker/%s" % (base, cid) ]:
+      if os.path.isdir(d):
+        return d
+    found = glob("%s/*/*%s*" % (base, cid)) + glob("%s/*/*/*%s*" % (base, cid))
+    return found[0] if found else None
+
+  def _dirs_of(self, cid):
+    if cid not in self._dirs:
+      if self.version == 2:
+        d = self._find(cid)
+        dirs = { "cpu": d,
+                 "memory": d if d and os.path.isfile(d + "/memory.current") else None,
+                 "io": d if d and os.path.isfile(d + "/io.stat") else None }
+      else:
+        dirs = { "cpu": self._find(cid, "cpuacct"),
+                 "memory": self._find(cid, "memory"),
+                 "io": self._find(cid, "blkio") }
+      if not dirs["cpu"]:
+        return None
+      self._dirs[cid] = dirs
+    return self._dirs[cid]
+
+  def _read(self, dirs):
+    if self.version == 2:
+      cpu = int(_keyed(dirs["cpu"] + "/cpu.stat")["usage_usec"]) * 1000
+      mem = int(_read_file(dirs["memory"] + "/memory.current")) if dirs["memory"] else 0
+      io = 0
+      if dirs["io"]:
+        for line in _read_file(dirs["io"] + "/io.stat").splitlines():
+          for kv in line.split()[1:]:
+            k, v = kv.split("=", 1)
+            if k in [ "rbytes", "wbytes" ]:
+              io += int(v)
+    else:
+      cpu = int(_read_file(dirs["cpu"] + "/cpuacct.usage"))
+      mem = int(_read_file(dirs["memory"] + "/memory.usage_in_bytes")) if dirs["memory"] else 0
+      io = 0
+      if dirs["io"]:
+        for line in _read_file(dirs["io"] + "/blkio.throttle.io_service_bytes").splitlines():
+          if line.startswith("Total"):
+            io = int(line.split()[1])
+    return cpu, mem, io
+
+  # Read usage of all the given containers. Containers not in the list are forgotten.
+  def collect(self, ids):
+    now = time.time()
+    usage = {}
+    for cid in ids:
+      dirs = self._dirs_of(cid)
+      if dirs is None:
+        continue
+      try:
+        cpu, mem, io = self._read(dirs)
+      except (IOError, OSError, KeyError, ValueError) as e:
+        self.logctl.debug("Cannot read cgroup of %s: %s", cid[:12], e)
+        continue
+      u = { "cpu": None, "cpu_time": cpu / 1e9, "mem": mem, "io": None }
+      if cid in self._last:
+        t0, cpu0, io0 = self._last[cid]
+        if now > t0:
+          u["cpu"] = (cpu-cpu0) / 1e9 / (now-t0)
+          u["io"] = (io-io0) / (now-t0)
+      self._last[cid] = (now, cpu, io)
+      usage[cid] = u
+    ids = set(ids)
+    for cid in self._dirs.keys():
+      if cid not in ids:
+        del self._dirs[cid]
+        self._last.pop(cid, None)
+    self.usage = usage
+    return usage
+
+def _read_file(path):
+  with open(path) as f:
+    return f.read()
+
+def _keyed(path):
+  return dict([ x.split(None, 1) for x in _read_file(path).splitlines() if x.strip() ])
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import threading, time, random, logging
+
+# Circuit breaker shared by all the calls to a remote service.
+# After `threshold` consecutive failures of the kinds listed in `trips` the circuit opens: calls fail
+# immediately with CircuitOpenError instead of waiting for the service. A background thread then
+# calls `probe` with a jittered exponential backoff, and closes the circuit as soon as it succeeds.
+# `on_change` is called with the new state at every transition, possibly from the probe thread.
+
+class CircuitOpenError(Exception):
+  pass
+
+class CircuitBreaker(object):
+  CLOSED = "closed"
+  OPEN = "open"
+  HALF_OPEN = "half-open"  # open, probe in progress
+
+  def __init__(self, name, probe, trips=(Exception,), threshold=1, min_backoff=2, max_backoff=60,
+               on_change=None):
+    self.name = name
+    self.probe = probe
+    self.trips = tuple(trips)
+    self.threshold = threshold
+    self.min_backoff = min_backoff
+    self.max_backoff = max_backoff
+    self.on_change = on_change
+    self.state = self.CLOSED
+    self.failures = 0        # consecutive failures
+    self.opened_at = None
+    self.last_error = None
+    self.logctl = logging.getLogger("circuit")
+    self._lock = threading.Lock()
+
+  def call(self, f, *args, **kwargs):
+    if self.state != self.CLOSED:
+      raise CircuitOpenError("%s unavailable since %d s, not trying: %s" % \
+                             (self.name, time.time()-self.opened_at, self.last_error))
+    try:
+      ret = f(*args, **kwargs)
+    except self.trips as e:
+      self._failed(e)
+      raise
+    self.failures = 0
+    return ret
+
+  def _failed(self, e):
+    with self._lock:
+      self.failures += 1
+      self.last_error = e
+      if self.state != self.CLOSED or self.failures < self.threshold:
+        return
+      self.state = self.OPEN
+      self.opened_at = time.time()
+    self.logctl.error("%s unavailable, failing fast until it recovers: %s" % (self.name, e))
+    self._changed()
+    t = threading.Thread(target=self._probe_loop, name="probe-%s" % self.name)
+    t.daemon = True
+    t.start()
+
+  def _probe_loop(self):
+    backoff = self.min_backoff
+    while True:
+      time.sleep(backoff * random.uniform(0.5, 1.5))
+      self.state = self.HALF_OPEN
+      try:
+        self.probe()
+      except Exception as e:
+        self.last_error = e
+        self.state = self.OPEN
+        backoff = min(backoff*2, self.max_backoff)
+        self.logctl.debug("%s still unavailable, probing again in about %d s: %s" % (self.name, backoff, e))
+        continue
+      with self._lock:
+        self.state = self.CLOSED
+        self.failures = 0
+      self.logctl.info("%s is back after %d s" % (self.name, time.time()-self.opened_at))
+      self._changed()
+      return
+
+  def _changed(self):
+    if self.on_change:
+      try:
+        self.on_change(self.state)
+      except Exception as e:
+        self.logctl.error("In circuit state callback: %s" % e)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import os, ast, re
+from pools import POOL_OPTIONS
+
+# Configuration file handling: change detection, schema validation and the max_docks expression.
+
+NUMBER = (int, long, float)
+
+# Accepted types of each configuration option, and minimum value of numeric ones.
+SCHEMA = {
+  "influxdb_url"       : (basestring, list),
+  "influxdb_batch"     : (int, long),
+  "influxdb_flush"     : NUMBER,
+  "metrics_port"       : (int, long),
+  "metrics_bind"       : basestring,
+  "updateconfig"       : NUMBER,
+  "image_expiration"   : NUMBER,
+  "image_jitter"       : NUMBER,
+  "main_sleep"         : NUMBER,
+  "scheduler"          : basestring,
+  "cpu_setpoint"       : NUMBER,
+  "pi_kp"              : NUMBER,
+  "pi_ki"              : NUMBER,
+  "grace_kill"         : NUMBER,
+  "grace_spawn"        : NUMBER,
+  "cpus_per_dock"      : NUMBER,
+  "max_docks"          : (basestring, int, long),
+  "docks_per_loop"     : (int, long),
+  "kills_per_loop"     : (int, long),
+  "victims"            : basestring,
+  "cpu_sampling"       : NUMBER,
+  "launch_parallelism" : (int, long),
+  "warm_pool"          : (int, long),
+  "inspect_parallelism": (int, long),
+  "kill_parallelism"   : (int, long),
+  "max_ttl"            : NUMBER,
+  "docker_image"       : basestring,
+  "docker_cmd"         : (basestring, list),
+  "docker_privileged"  : bool,
+  "max_dock_mem"       : (int, long),
+  "max_dock_swap"      : (int, long),
+  "user_group"         : basestring,
+  "binds"              : list,
+  "devices"            : list,
+  "capabilities"       : list,
+  "security_opts"      : list,
+  "docker_events"      : bool,
+  "idle_dock_cpu"      : NUMBER,
+  "mem_available_spawn": NUMBER,
+  "mem_available_kill" : NUMBER,
+  "mem_pressure_spawn" : NUMBER,
+  "mem_pressure_kill"  : NUMBER,
+  "cpuset"             : bool,
+  "journal_days"       : NUMBER,
+  "log_format"         : basestring,
+  "dump_interval"      : NUMBER,
+  "pools"              : dict
+}
+POOL_SCHEMA = dict([ (k, SCHEMA[k]) for k in POOL_OPTIONS ], weight=NUMBER)
+MINIMUM = {
+  "influxdb_batch"     : 1,
+  "influxdb_flush"     : 0,
+  "metrics_port"       : 0,
+  "updateconfig"       : 0,
+  "image_expiration"   : 0,
+  "image_jitter"       : 0,
+  "main_sleep"         : 1,
+  "cpu_setpoint"       : 0,
+  "grace_kill"         : 0,
+  "grace_spawn"        : 0,
+  "cpus_per_dock"      : 0.01,
+  "docks_per_loop"     : 0,
+  "kills_per_loop"     : 0,
+  "cpu_sampling"       : 1,
+  "launch_parallelism" : 1,
+  "warm_pool"          : 0,
+  "inspect_parallelism": 1,
+  "kill_parallelism"   : 1,
+  "max_ttl"            : 0,
+  "max_dock_mem"       : 0,
+  "max_dock_swap"      : 0,
+  "weight"             : 0,
+  "mem_available_spawn": 0,
+  "mem_available_kill" : 0,
+  "mem_pressure_spawn" : 0,
+  "mem_pressure_kill"  : 0,
+  "journal_days"       : 0,
+  "dump_interval"      : 0
+}
+
+# Remove the unknown options of a configuration, including the ones of its pools, so that a typo or an
+# option of another version does not invalidate the whole file. Returns the names of the removed ones.
+def drop_unknown(conf, schema=SCHEMA):
+  dropped = sorted([ k for k in conf if k not in schema ])
+  for k in dropped:
+    del conf[k]
+  if schema is SCHEMA and isinstance(conf.get("pools"), dict):
+    for name, opts in sorted(conf["pools"].items()):
+      if isinstance(opts, dict):
+        dropped += [ "pools.%s.%s" % (name, k) for k in drop_unknown(opts, POOL_SCHEMA) ]
+  return dropped
+
+# List of problems found in a configuration, empty if it is valid. Unknown options are problems too:
+# remove them first with drop_unknown to ignore them. Options without a value (None) are valid, and
+# mean the default.
+def validate(conf, schema=SCHEMA):
+  errors = []
+  for k, v in sorted(conf.items()):
+    if v is None:
+      continue
+    if k not in schema:
+      errors.append("unknown option %s" % k)
+    elif not isinstance(v, schema[k]) or (isinstance(v, bool) and schema[k] is not bool):
+      errors.append("%s: invalid value %r" % (k, v))
+    elif k in MINIMUM and v < MINIMUM[k]:
+      errors.append("%s: %r is below the minimum of %r" % (k, v, MINIMUM[k]))
+    elif k == "pools":
+      errors += _validate_pools(v)
+  return errors
+
+# Pool names are also part of container names: they are restricted to lowercase letters, digits and
+# underscores, so that the prefix of a pool is never the one of another.
+def _validate_pools(pools):
+  errors = []
+  for name, opts in sorted(pools.items()):
+    if not isinstance(name, basestring) or not re.match(r"^[a-z0-9_]+$", name):
+      errors.append("pools: invalid pool name %r" % (name,))
+    elif not isinstance(opts, (dict, type(None))):
+      errors.append("pools: %s: not a dictionary" % name)
+    else:
+      errors += [ "pools: %s: %s" % (name, e) for e in validate(opts or {}, POOL_SCHEMA) ]
+  return errors
+
+# Watch a file for changes by comparing its inode, size and modification time to the ones seen at
+# the last call of `changed()`. A missing file is a state like any other.
+class WatchedFile(object):
+
+  def __init__(self, path):
+    self.path = path
+    self._seen = False
+    self._sig = None
+
+  def changed(self):
+    try:
+      st = os.stat(self.path)
+      sig = (st.st_ino, st.st_size, st.st_mtime)
+    except OSError:
+      sig = None
+    changed = not self._seen or sig != self._sig
+    self._seen = True
+    self._sig = sig
+    return changed
+
+# Arithmetic expression over a set of named inputs, e.g. "min(ncpus - 2, ram_bytes / max_dock_mem)".
+# It is parsed once and only arithmetic, comparisons, conditionals, the allowed names and a few pure
+# functions are accepted. `evaluate()` takes a function returning the value of a name, only calls it
+# for the names used by the expression, and recomputes the result only when one of them changed.
+class Expression(object):
+
+  FUNCTIONS = { "min": min, "max": max, "int": int, "float": float, "abs": abs, "round": round }
+  NODES = ( ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call,
+            ast.Name, ast.Num, ast.Load, ast.operator, ast.unaryop, ast.boolop, ast.cmpop )
+
+  def __init__(self, source, names):
+    self.source = str(source)
+    tree = ast.parse(self.source.strip(), mode="eval")
+    self.names = set()
+    for node in ast.walk(tree):
+      if not isinstance(node, self.NODES):
+        raise ValueError("%s not allowed in %s" % (node.__class__.__name__, self.source))
+      if isinstance(node, ast.Call) and \
+         (not isinstance(node.func, ast.Name) or node.func.id not in self.FUNCTIONS or \
+          node.keywords or node.starargs or node.kwargs):
+        raise ValueError("only calls to %s are allowed" % ", ".join(sorted(self.FUNCTIONS)))
+      if isinstance(node, ast.Name) and node.id not in self.FUNCTIONS:
+        if node.id not in names:
+          raise ValueError("unknown name %s, valid: %s" % (node.id, ", ".join(sorted(names))))
+        self.names.add(node.id)
+    self._code = compile(tree, "<max_docks>", "eval")
+    self._inputs = None
+    self.value = None
+
+  def evaluate(self, lookup):
+    inputs = dict([ (n, lookup(n)) for n in self.names ])
+    if inputs != self._inputs:
+      env = dict(self.FUNCTIONS, __builtins__={})
+      env.update(inputs)
+      self.value = eval(self._code, env)
+      self._inputs = inputs
+    return self.value
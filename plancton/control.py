@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import socket, threading, json, os, errno, logging
+
+# Local control channel of a running daemon, served on a Unix domain socket.
+# A client connects, sends one command on a single line, and receives one JSON object on a single line
+# before the connection is closed. Replies always contain "ok": on success, the other keys are the ones
+# returned by the command handler, on failure "error" describes the problem.
+# Handlers are called from the server thread, one request at a time.
+
+class ControlServer(object):
+
+  def __init__(self, path, handlers, timeout=5):
+    self.path = path
+    self.handlers = handlers  # command -> function returning a dict
+    self.timeout = timeout
+    self.logctl = logging.getLogger("control")
+    self._sock = None
+    self._thread = None
+    self._stop = threading.Event()
+
+  def start(self):
+    try:
+      os.remove(self.path)  # stale socket of a previous instance
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(self.path)
+    os.chmod(self.path, 0600)
+    sock.listen(5)
+    sock.settimeout(1)
+    self._sock = sock
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._serve, name="control")
+    self._thread.daemon = True
+    self._thread.start()
+    self.logctl.debug("Accepting commands on %s" % self.path)
+
+  def stop(self):
+    self._stop.set()
+    if self._thread:
+      self._thread.join(2)
+    if self._sock:
+      self._sock.close()
+      self._sock = None
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+  def _serve(self):
+    while not self._stop.is_set():
+      try:
+        conn, _ = self._sock.accept()
+      except socket.timeout:
+        continue
+      except socket.error as e:
+        if self._stop.is_set():
+          return
+        self.logctl.error("Cannot accept control connection: %s" % e)
+        continue
+      try:
+        conn.settimeout(self.timeout)
+        conn.sendall(json.dumps(self.handle(_read_line(conn))) + "\n")
+      except socket.error as e:
+        self.logctl.warning("Control connection failed: %s" % e)
+      finally:
+        conn.close()
+
+  def handle(self, command):
+    command = command.strip()
+    if command not in self.handlers:
+      return { "ok": False, "error": "unknown command %s, valid: %s" % \
+                                     (command, ", ".join(sorted(self.handlers))) }
+    self.logctl.debug("Control command: %s" % command)
+    try:
+      return dict(self.handlers[command]() or {}, ok=True)
+    except Exception as e:
+      self.logctl.error("Control command %s failed: %s" % (command, e))
+      return { "ok": False, "error": str(e) }
+
+# Send a command to the daemon listening on `path` and return its reply. Raises socket.error when no
+# daemon can be reached.
+def control_request(path, command, timeout=5):
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(timeout)
+  try:
+    sock.connect(path)
+    sock.sendall(command + "\n")
+    reply = _read_line(sock)
+  finally:
+    sock.close()
+  try:
+    return json.loads(reply)
+  except ValueError:
+    raise socket.error("invalid reply from %s: %r" % (path, reply[:100]))
+
+def _read_line(sock):
+  buf = ""
+  while "\n" not in buf:
+    data = sock.recv(4096)
+    if not data:
+      break
+    buf += data
+  return buf.split("\n", 1)[0]
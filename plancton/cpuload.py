@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import deque
+
+# Host CPU load sampled from /proc/stat, meant to be sampled several times per main loop.
+# Load is the percentage of non-idle time over all CPUs since the previous sample, where time spent
+# waiting for I/O counts as idle. Samples are smoothed with an exponentially weighted moving average;
+# `value()` follows rises immediately and decreases smoothly, so that load appearing on the host is
+# seen at once while short idle periods do not trigger new containers.
+# CPU pressure (share of time some task waited for a CPU over the last 10 s) is read from
+# /proc/pressure/cpu when the kernel provides it, and is 0 otherwise.
+
+class CpuLoadSampler(object):
+
+  def __init__(self, alpha=0.3, history=120, stat="/proc/stat", pressure="/proc/pressure/cpu"):
+    self.alpha = alpha
+    self.history = deque(maxlen=history)  # (time, load) of the last samples, see recent()
+    self.stat = stat
+    self.pressure_file = pressure
+    self.ewma = None
+    self.last = None       # load of the last sample (%)
+    self.per_cpu = []      # load of each CPU in the last sample (%)
+    self.pressure = 0.0
+    self._prev = None
+    self.sample()
+
+  # Idle and total jiffies of each line of /proc/stat: "cpu" first, then one per CPU.
+  def _read(self):
+    times = []
+    with open(self.stat) as f:
+      for line in f:
+        if not line.startswith("cpu"):
+          break
+        t = [ int(x) for x in line.split()[1:9] ]  # user nice system idle iowait irq softirq steal
+        times.append((t[3]+t[4], sum(t)))
+    return times
+
+  def _read_pressure(self):
+    try:
+      with open(self.pressure_file) as f:
+        for line in f:
+          if line.startswith("some"):
+            return float(dict([ x.split("=") for x in line.split()[1:] ])["avg10"])
+    except (IOError, KeyError, ValueError):
+      pass
+    return 0.0
+
+  def sample(self):
+    cur = self._read()
+    self.pressure = self._read_pressure()
+    prev, self._prev = self._prev, cur
+    if prev is None or len(prev) != len(cur):
+      return self.last
+    loads = []
+    for (idle0, total0), (idle1, total1) in zip(prev, cur):
+      dt = total1 - total0
+      loads.append(100. * (dt - (idle1-idle0)) / dt if dt > 0 else 0.)
+    if cur[0][1] == prev[0][1]:
+      return self.last  # no time elapsed
+    self.last = loads[0]
+    self.per_cpu = loads[1:]
+    self.ewma = self.last if self.ewma is None else self.alpha*self.last + (1-self.alpha)*self.ewma
+    self.history.append((time.time(), self.last))
+    return self.last
+
+  # Mean and max load (%) of the samples taken in the last `seconds`, (None, None) without samples.
+  def recent(self, seconds):
+    since = time.time() - seconds
+    loads = [ load for t, load in self.history if t >= since ]
+    return (sum(loads) / len(loads), max(loads)) if loads else (None, None)
+
+  # Smoothed load (%), None before two samples are taken.
+  def value(self):
+    if self.ewma is None:
+      return None
+    return max(self.ewma, self.last)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import threading, logging
+from snapshot import container_name, container_state
+
+# Follow the Docker events stream in a background thread and keep an in-memory table with the state
+# of the containers whose name starts with a given prefix. Old API versions do not report container
+# names: their events are recognized by the ids in the table.
+# The stream uses its own Docker client, as it keeps one connection busy for its whole lifetime.
+# The `on_change` callback is invoked from the watcher thread with (action, container_id).
+
+class ContainerEventWatcher(object):
+  transitions = { "create": "created",
+                  "start": "running",
+                  "restart": "running",
+                  "unpause": "running",
+                  "pause": "paused",
+                  "die": "exited" }
+
+  def __init__(self, client_factory, prefix, on_change=None, max_backoff=30):
+    self.client_factory = client_factory
+    self.prefix = prefix
+    self.on_change = on_change
+    self.max_backoff = max_backoff
+    self.states = {}  # container id -> state
+    self.connected = False
+    self.logctl = logging.getLogger("events")
+    self._lock = threading.Lock()
+    self._client = None
+    self._thread = None
+    self._stop = threading.Event()
+
+  def start(self):
+    if self._thread and self._thread.is_alive():
+      return
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name="docker-events")
+    self._thread.daemon = True
+    self._thread.start()
+
+  # Stop following events. The streaming connection is closed to unblock the reader.
+  def stop(self):
+    self._stop.set()
+    try:
+      self._client.close()
+    except Exception:
+      pass
+
+  def is_alive(self):
+    return self._thread is not None and self._thread.is_alive()
+
+  # Replace the state table with what a full container list reports. Called at every poll to
+  # recover from events missed while disconnected.
+  def reconcile(self, containers):
+    states = dict([ (c["Id"], container_state(c)) for c in containers
+                    if container_name(c).startswith(self.prefix) ])
+    with self._lock:
+      self.states = states
+
+  def handle(self, event):
+    action = event.get("Action", event.get("status", ""))
+    cid = event.get("Actor", {}).get("ID", event.get("id"))
+    name = event.get("Actor", {}).get("Attributes", {}).get("name")
+    if not cid or (event.get("Type", "container") != "container"):
+      return
+    with self._lock:
+      # Old API versions do not report names: rely on already known ids in that case
+      if not (name.startswith(self.prefix) if name else cid in self.states):
+        return
+      if action == "destroy":
+        self.states.pop(cid, None)
+      elif action in self.transitions:
+        self.states[cid] = self.transitions[action]
+      else:
+        return
+    self.logctl.debug("Container %s: %s", cid[:12], action)
+    if self.on_change:
+      self.on_change(action, cid)
+
+  def _run(self):
+    backoff = 1
+    while not self._stop.is_set():
+      try:
+        self._client = self.client_factory()
+        stream = self._client.events(decode=True, filters={ "type": "container" })
+        self.connected = True
+        backoff = 1
+        self.logctl.info("Following Docker events")
+        for event in stream:
+          if self._stop.is_set():
+            break
+          self.handle(event)
+      except Exception as e:
+        if not self._stop.is_set():
+          self.logctl.warning("Docker events stream interrupted, reconnecting in %d s: %s" % (backoff, e))
+      self.connected = False
+      self._stop.wait(backoff)
+      backoff = min(backoff*2, self.max_backoff)
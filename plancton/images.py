@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import threading, time, logging
+
+# Keeps the worker image up to date in the background.
+# `refresh(name)` starts a thread that compares the digest of the local image with the one in the
+# registry, and pulls only if they differ or cannot be compared. The image in use, `current`, is
+# switched to the new one only when it is fully available locally, so containers keep being started
+# from the previous image while a pull is in progress. Docker operations are given as functions:
+#   inspect(name):       local image information, raising if the image is not present
+#   remote_digest(name): digest of the image in the registry
+#   pull(name):          pull the image, raising on failure
+
+# Split an image reference into repository and tag ("latest" by default). A registry port is not a tag.
+def split_image(name):
+  repo, _, tag = name.rpartition(":")
+  if not repo or "/" in tag:
+    return name, "latest"
+  return repo, tag
+
+class ImageUpdater(object):
+
+  def __init__(self, inspect, remote_digest, pull, on_ready=None):
+    self.inspect = inspect
+    self.remote_digest = remote_digest
+    self.pull = pull
+    self.on_ready = on_ready
+    self.current = None      # (name, local ID) of the image in use: containers are created from the ID
+    self.checked = None      # last time the image in use was found up to date
+    self.pulls = 0           # pulls actually done
+    self.last_error = None
+    self.logctl = logging.getLogger("images")
+    self._thread = None
+
+  def busy(self):
+    return self._thread is not None and self._thread.is_alive()
+
+  # Start refreshing image `name` in the background. Returns False if a refresh is already running.
+  def refresh(self, name):
+    if self.busy():
+      return False
+    self._thread = threading.Thread(target=self._run, args=(name,), name="image-refresh")
+    self._thread.daemon = True
+    self._thread.start()
+    return True
+
+  def _run(self, name):
+    try:
+      local = self._local(name)
+      if local and self._up_to_date(name, local):
+        self.logctl.debug("Image %s is up to date" % name)
+      else:
+        self.logctl.info("Pulling image %s" % name)
+        self.pull(name)
+        self.pulls += 1
+        local = self.inspect(name)
+      self._ready(name, local["Id"])
+    except Exception as e:
+      self.last_error = e
+      self.logctl.error("Cannot refresh image %s: %s" % (name, e))
+
+  def _local(self, name):
+    try:
+      return self.inspect(name)
+    except Exception as e:
+      self.logctl.debug("Image %s not found locally: %s" % (name, e))
+      return None
+
+  # Whether the registry has the same image as the local one. Images pulled by digest or built
+  # locally cannot be compared, and are refreshed only by pulling.
+  def _up_to_date(self, name, local):
+    try:
+      remote = self.remote_digest(name)
+    except Exception as e:
+      self.logctl.debug("Cannot get the registry digest of %s, pulling: %s" % (name, e))
+      return False
+    digests = [ d.split("@", 1)[1] for d in local.get("RepoDigests") or [] if "@" in d ]
+    return remote in digests
+
+  def _ready(self, name, image_id):
+    self.checked = time.time()
+    if (name, image_id) == self.current:
+      return
+    self.logctl.info("Using image %s (%s)" % (name, image_id[:19]))
+    self.current = (name, image_id)
+    if self.on_ready:
+      self.on_ready(name, image_id)
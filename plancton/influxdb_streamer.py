@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
-import os, requests, logging
+import os, requests, logging, time, threading
+from collections import deque
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 
 # Class used to stream data to an InfluxDB database.
 # Exceptions and logging are supposed to be managed by the calling module.
 # Plancton must handle every exception.
+# Points are buffered and sent by a background thread as a single multi-line write when `batch_size`
+# points are buffered or the oldest one is older than `batch_age` seconds: calling the streamer never
+# blocks on the network. Unsent points are kept for the next attempt, up to `max_buffer` points: the
+# oldest ones are dropped beyond that.
+# Each streamer keeps its own pool of at most `pool_size` keep-alive connections, and creates its
+# database only once, the first time a write fails.
 
 class InfluxDBStreamer():
   __version__ = "0.1"
-  def __init__(self, baseurl, database):
+  def __init__(self, baseurl, database, batch_size=100, batch_age=60, max_buffer=5000, pool_size=2):
     if baseurl.startswith("insecure_https:"):
       self.ssl_verify = False
       self.real_baseurl = baseurl[9:]
@@ -20,16 +28,37 @@ class InfluxDBStreamer():
     self.logctl = logging.getLogger("influxdb_streamer")
     self._headers_query = {"Content-type": "application/json", "Accept": "text/plain"}
     self._headers_write = {"Content-type": "application/octet-stream", "Accept": "text/plain"}
+    self.batch_size = batch_size
+    self.batch_age = batch_age
+    self.max_buffer = max_buffer
+    self.retry_delay = 10
+    self._buffer = deque()
+    self._buffer_since = None
+    self._flush_requested = False
+    self._closing = False
+    self._cond = threading.Condition()
+    self.points_buffered = 0
+    self.points_flushed = 0
+    self.points_dropped = 0
+    self._db_checked = False  # database known to exist, or creation already attempted
+    self._session = requests.Session()
+    self._session.verify = self.ssl_verify
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self._session.mount("http://", adapter)
+    self._session.mount("https://", adapter)
+    self._thread = threading.Thread(target=self._worker, name="influxdb-%s" % database)
+    self._thread.daemon = True
+    self._thread.start()
 
   def create_db(self):
+    self._db_checked = True
     try:
       self.logctl.debug("Creating database: %s" % self.database)
-      r = requests.get(self.real_baseurl + "/query",
-                       headers=self._headers_query,
-                       params={ "q": "CREATE DATABASE \"%s\"" % self.database,
-                                "db": self.database },
-                       timeout=5,
-                       verify=self.ssl_verify)
+      r = self._session.get(self.real_baseurl + "/query",
+                            headers=self._headers_query,
+                            params={ "q": "CREATE DATABASE \"%s\"" % self.database,
+                                     "db": self.database },
+                            timeout=5)
       self.logctl.debug("Creating database %s returned %d" % (self.database, r.status_code))
       r.raise_for_status()
       return True
@@ -44,29 +73,110 @@ class InfluxDBStreamer():
                   ",".join(["%s=%s" % (x,tags[x]) for x in tags]) + " " +     \
                   ",".join(["%s=%s" % (x,fields[x]) for x in fields]) + " " + \
                   str(int((datetime.utcnow()-datetime.utcfromtimestamp(0)).total_seconds()*1000000000))
-    self.logctl.debug("Sending line to database %s: %s" % (self.database, data_string))
+    self.logctl.debug("Buffering line for database %s: %s", self.database, data_string)
+    with self._cond:
+      if not self._buffer:
+        self._buffer_since = time.time()
+      self._buffer.append(data_string)
+      self.points_buffered += 1
+      self._trim()
+      self._cond.notify()
+    return True
 
-    db_created = False
+  # Drop the oldest points exceeding the buffer size. Called with the lock held.
+  def _trim(self):
+    excess = len(self._buffer) - self.max_buffer
+    if excess > 0:
+      self.logctl.warning("Buffer for database %s full: dropping %d point(s)", self.database, excess)
+      for _ in range(excess):
+        self._buffer.popleft()
+      self.points_dropped += excess
+
+  # Seconds until buffered points must be sent, zero if they are due. Called with the lock held.
+  def _due_in(self):
+    if self._flush_requested or self._closing or len(self._buffer) >= self.batch_size:
+      return 0
+    if not self._buffer:
+      return None
+    return max(0, self._buffer_since + self.batch_age - time.time())
+
+  # Send lines in one request. On failure they are put back in front of the buffer.
+  def _send(self, lines):
+    if self._write("\n".join(lines)):
+      with self._cond:
+        self.points_flushed += len(lines)
+      return True
+    with self._cond:
+      self._buffer.extendleft(reversed(lines))
+      self._trim()
+    return False
+
+  def _take(self):
+    with self._cond:
+      lines = list(self._buffer)
+      self._buffer.clear()
+      self._flush_requested = False
+      return lines
+
+  def _worker(self):
+    while True:
+      with self._cond:
+        while self._due_in() != 0:
+          self._cond.wait(self._due_in())
+        closing = self._closing
+      lines = self._take()
+      if lines and not self._send(lines) and not closing:
+        time.sleep(self.retry_delay)
+      if closing:
+        self._session.close()
+        return
+
+  # Ask the background thread to send buffered points now, without waiting.
+  def request_flush(self):
+    with self._cond:
+      self._flush_requested = True
+      self._cond.notify()
+
+  # Send all buffered points from the calling thread. Use at shutdown only, as it blocks.
+  def flush(self):
+    lines = self._take()
+    return self._send(lines) if lines else True
+
+  # Counters of points through this streamer.
+  def stats(self):
+    with self._cond:
+      return { "buffered": self.points_buffered,
+               "flushed": self.points_flushed,
+               "dropped": self.points_dropped,
+               "pending": len(self._buffer) }
+
+  def _write(self, data_string):
+    self.logctl.debug("Sending %d line(s) to database %s", data_string.count("\n")+1, self.database)
     while True:
       try:
-        r = requests.post(self.real_baseurl+"/write",
-                          headers=self._headers_write,
-                          params={ "db": self.database },
-                          data=data_string.encode("utf-8"),
-                          timeout=5,
-                          verify=self.ssl_verify)
-        self.logctl.debug("Sending data returned %d" % r.status_code)
+        r = self._session.post(self.real_baseurl+"/write",
+                               headers=self._headers_write,
+                               params={ "db": self.database },
+                               data=data_string.encode("utf-8"),
+                               timeout=5)
+        self.logctl.debug("Sending data returned %d", r.status_code)
         r.raise_for_status()
+        self._db_checked = True
         return True
       except requests.exceptions.RequestException as e:
-        if db_created:
-          self.logctl.error("Error sending data: %s" % e)
+        if self._db_checked:
+          self.logctl.error("Error sending data: %s", e)
           return False
         else:
-          self.logctl.debug("Error sending data: %s - trying to create database" % e)
+          self.logctl.debug("Error sending data: %s - trying to create database", e)
           if not self.create_db():
             return False
-          db_created = True
+
+  # Send what is left in the background, then stop the thread and release pooled connections.
+  def close(self):
+    with self._cond:
+      self._closing = True
+      self._cond.notify()
 
   def __hash__(self):
     return hash(self.baseurl + "#" + self.database)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import sqlite3, threading, time
+
+# Journal of the lifecycle of workers, kept in an SQLite database in WAL mode in the run directory.
+# Each worker has one row, updated when it is created, started and finished (removed, or found exited
+# or gone), with the reason it finished:
+#   - "ttl": killed after max_ttl;
+#   - "force-stop": killed by a force-stop;
+#   - "scheduler", "memory": killed to free slots, by the scheduler or by memory admission control;
+#   - "exited": terminated by itself;
+#   - "not started", "unused": created and never started, or removed from the warm pool;
+#   - another container state (e.g. "dead"), or "vanished" if removed behind the back of Plancton.
+# The running workers are restored from it on restart, so that they do not need to be inspected, and
+# history queries are answered locally. Writes are serialized, and committed one by one: in WAL mode
+# with synchronous=NORMAL they do not wait for the disk.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+  id       TEXT PRIMARY KEY,
+  name     TEXT,
+  pool     TEXT,
+  config   TEXT,
+  created  REAL,
+  started  REAL,
+  pid      INTEGER,
+  cpuset   TEXT,
+  cpus     REAL,
+  finished REAL,
+  uptime   REAL,
+  reason   TEXT
+);
+CREATE INDEX IF NOT EXISTS workers_finished ON workers (finished);
+CREATE INDEX IF NOT EXISTS workers_started ON workers (started);
+"""
+
+class Journal(object):
+
+  def __init__(self, path):
+    self.path = path
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._db.execute("PRAGMA journal_mode=WAL")
+      self._db.execute("PRAGMA synchronous=NORMAL")
+      self._db.executescript(SCHEMA)
+      self._db.commit()
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+  def _write(self, sql, args):
+    with self._lock:
+      self._db.execute(sql, args)
+      self._db.commit()
+
+  def _read(self, sql, args=()):
+    with self._lock:
+      return self._db.execute(sql, args).fetchall()
+
+  def created(self, cid, name, pool, config, when=None):
+    self._write("INSERT OR IGNORE INTO workers (id, name, pool, config, created) VALUES (?, ?, ?, ?, ?)",
+                (cid, name, pool, config, when or time.time()))
+
+  # Workers started by a previous instance without a journal get their row here.
+  def started(self, cid, name, pool, when, pid, cpuset=None, cpus=None):
+    with self._lock:
+      self._db.execute("INSERT OR IGNORE INTO workers (id, name, pool, created) VALUES (?, ?, ?, ?)",
+                       (cid, name, pool, when))
+      self._db.execute("UPDATE workers SET started = ?, pid = ?, cpuset = ?, cpus = ? WHERE id = ?",
+                       (when, pid, cpuset, cpus, cid))
+      self._db.commit()
+
+  # Only the first end of a worker is recorded. Without `uptime`, it is counted from its start.
+  def finished(self, cid, reason, uptime=None, when=None):
+    when = when or time.time()
+    self._write("UPDATE workers SET finished = ?, reason = ?, uptime = COALESCE(?, ? - started) "
+                "WHERE id = ? AND finished IS NULL", (when, reason, uptime, when, cid))
+
+  # Workers not finished: id -> (started, pid, cpuset, cpus), started being None if they never started.
+  def unfinished(self):
+    return dict([ (r[0], r[1:]) for r in self._read("SELECT id, started, pid, cpuset, cpus FROM workers "
+                                                    "WHERE finished IS NULL") ])
+
+  # Forget workers finished before `before`. Returns how many were forgotten.
+  def prune(self, before):
+    with self._lock:
+      n = self._db.execute("DELETE FROM workers WHERE finished < ?", (before,)).rowcount
+      self._db.commit()
+    return n
+
+  # Workers started and finished per hour since `since`, mean uptime of the finished ones, and how
+  # many finished for each reason, in total and per pool.
+  def history(self, since):
+    hours = {}
+    for hour, n in self._read("SELECT CAST(started / 3600 AS INTEGER) * 3600, COUNT(*) FROM workers "
+                              "WHERE started >= ? GROUP BY 1", (since,)):
+      hours[hour] = { "started": n, "finished": 0, "mean_uptime": None }
+    for hour, n, uptime in self._read("SELECT CAST(finished / 3600 AS INTEGER) * 3600, COUNT(*), AVG(uptime) "
+                                      "FROM workers WHERE finished >= ? AND started IS NOT NULL GROUP BY 1",
+                                      (since,)):
+      hours.setdefault(hour, { "started": 0 }).update(finished=n, mean_uptime=uptime)
+    pools = {}
+    for pool, reason, n, uptime in self._read("SELECT pool, reason, COUNT(*), SUM(uptime) FROM workers "
+                                              "WHERE finished >= ? GROUP BY 1, 2", (since,)):
+      p = pools.setdefault(pool, { "finished": 0, "uptime": 0., "reasons": {} })
+      p["reasons"][reason] = n
+      if reason not in [ "not started", "unused" ]:
+        p["finished"] += n
+        p["uptime"] += uptime or 0.
+    for p in pools.itervalues():
+      p["mean_uptime"] = p.pop("uptime") / p["finished"] if p["finished"] else None
+    finished = sum([ p["finished"] for p in pools.itervalues() ])
+    return { "since": since,
+             "hours": dict([ (str(h), v) for h, v in hours.iteritems() ]),
+             "pools": pools,
+             "finished": finished,
+             "mean_uptime": sum([ p["mean_uptime"] * p["finished"] for p in pools.itervalues()
+                                  if p["finished"] ]) / finished if finished else None }
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import logging, threading, Queue, atexit, json, time
+
+# Asynchronous logging. The handlers of the root logger are moved behind a queue: loggers only put
+# records on it, and a background thread formats them and writes them out, so that neither formatting
+# nor file or syslog I/O happens on the main loop.
+# Messages are formatted by the writer: log with arguments (logctl.debug("x %s", y)) rather than with
+# the % operator, and wrap expensive arguments in Deferred, computed only when written. Arguments must
+# not change after being logged. Tracebacks are formatted when logged, as they do not survive.
+# When the queue is full, records below WARNING are dropped and counted, others wait for room.
+
+# Argument computed when the message is formatted, e.g. Deferred(json.dumps, spec, indent=2).
+class Deferred(object):
+  def __init__(self, func, *args, **kwargs):
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+
+  def __str__(self):
+    return str(self.func(*self.args, **self.kwargs))
+
+class QueueHandler(logging.Handler):
+
+  def __init__(self, queue):
+    logging.Handler.__init__(self)
+    self.queue = queue
+    self.dropped = 0
+
+  def emit(self, record):
+    if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+    try:
+      self.queue.put_nowait(record)
+    except Queue.Full:
+      if record.levelno < logging.WARNING:
+        self.dropped += 1
+      else:
+        self.queue.put(record)
+
+class QueueListener(object):
+
+  def __init__(self, queue, handler, handlers):
+    self.queue = queue
+    self.handler = handler    # QueueHandler feeding the queue, for its count of dropped records
+    self.handlers = handlers
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name="log")
+    self._thread.daemon = True
+    self._thread.start()
+    atexit.register(self.stop)
+
+  # Write out the records queued so far, and stop.
+  def stop(self):
+    if self._thread:
+      self.queue.put(None)
+      self._thread.join()
+      self._thread = None
+
+  def _run(self):
+    while True:
+      record = self.queue.get()
+      if record is None:
+        return
+      if self.handler.dropped:
+        dropped, self.handler.dropped = self.handler.dropped, 0
+        self._handle(logging.makeLogRecord({ "name": "log", "levelno": logging.WARNING, "levelname": "WARNING",
+                                             "msg": "%d log record(s) dropped: logging too fast" % dropped }))
+      self._handle(record)
+
+  def _handle(self, record):
+    for handler in self.handlers:
+      if record.levelno >= handler.level:
+        try:
+          handler.handle(record)
+        except Exception:
+          handler.handleError(record)
+
+# Move the handlers of `logger` behind a queue of at most `size` records. Returns the QueueListener
+# writing them out, already started.
+def make_async(logger, size=10000):
+  queue = Queue.Queue(size)
+  handler = QueueHandler(queue)
+  listener = QueueListener(queue, handler, list(logger.handlers))
+  for h in listener.handlers:
+    logger.removeHandler(h)
+  logger.addHandler(handler)
+  listener.start()
+  return listener
+
+# One JSON object per line, for bulk ingestion: time (epoch and UTC), level, logger, origin, message,
+# and the traceback if any.
+class JsonFormatter(logging.Formatter):
+  def format(self, record):
+    entry = { "time": record.created,
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + \
+                           ".%03dZ" % record.msecs,
+              "level": record.levelname,
+              "logger": record.name,
+              "module": record.module,
+              "function": record.funcName,
+              "thread": record.threadName,
+              "message": record.getMessage() }
+    if record.exc_text:
+      entry["traceback"] = record.exc_text
+    return json.dumps(entry)
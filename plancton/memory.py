@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import math
+
+# Host memory state, read from /proc/meminfo (MemTotal and MemAvailable) and, when the kernel provides
+# it, /proc/pressure/memory: share of time some tasks ("some") or all non-idle tasks ("full") were
+# stalled waiting for memory over the last 10 s.
+
+class MemorySampler(object):
+
+  def __init__(self, meminfo="/proc/meminfo", pressure="/proc/pressure/memory"):
+    self.meminfo = meminfo
+    self.pressure_file = pressure
+    self.total = None      # bytes, None if unknown
+    self.available = None  # bytes
+    self.some = 0.0        # memory pressure (%)
+    self.full = 0.0
+
+  def sample(self):
+    try:
+      with open(self.meminfo) as f:
+        info = dict([ (x.split(":")[0], int(x.split()[1])*1024) for x in f if x.split()[1:2] ])
+      self.total, self.available = info["MemTotal"], info["MemAvailable"]
+    except (IOError, KeyError, ValueError):
+      self.total = self.available = None
+    self.some = self.full = 0.0
+    try:
+      with open(self.pressure_file) as f:
+        for line in f:
+          avg10 = float(dict([ x.split("=") for x in line.split()[1:] ])["avg10"])
+          if line.startswith("some"):
+            self.some = avg10
+          elif line.startswith("full"):
+            self.full = avg10
+    except (IOError, KeyError, ValueError):
+      pass
+
+  # Available memory as a percentage of the total.
+  def available_pct(self):
+    return 100. * self.available / self.total
+
+# Admission control on top of the scheduler decision. Workers are killed when available memory drops
+# below `mem_available_kill` percent of the total (enough of them to get back above it, counting
+# `per_dock` bytes each), or when the full memory pressure exceeds `mem_pressure_kill` percent (one per
+# loop). New workers are refused below `mem_available_spawn` percent of available memory or above
+# `mem_pressure_spawn` percent of some pressure, and are limited to the ones fitting in the memory
+# available above `mem_available_spawn`. Thresholds set to 0 are disabled.
+# Returns (spawn, shed, decision, reason), decision being "accept", "limit", "refuse" or "shed".
+def admission(mem, spawn, shed, conf, per_dock):
+  if mem.total is None:
+    return spawn, shed, "accept", "memory information not available"
+  avail = mem.available_pct()
+  if avail < conf["mem_available_kill"]:
+    deficit = conf["mem_available_kill"] * mem.total / 100. - mem.available
+    return 0, max(shed, int(math.ceil(deficit / per_dock)), 1), "shed", \
+           "%.1f%% of memory available, below %g%%" % (avail, conf["mem_available_kill"])
+  if conf["mem_pressure_kill"] and mem.full > conf["mem_pressure_kill"]:
+    return 0, max(shed, 1), "shed", \
+           "full memory pressure %.1f%%, above %g%%" % (mem.full, conf["mem_pressure_kill"])
+  if spawn:
+    if avail < conf["mem_available_spawn"]:
+      return 0, shed, "refuse", \
+             "%.1f%% of memory available, below %g%%" % (avail, conf["mem_available_spawn"])
+    if conf["mem_pressure_spawn"] and mem.some > conf["mem_pressure_spawn"]:
+      return 0, shed, "refuse", \
+             "memory pressure %.1f%%, above %g%%" % (mem.some, conf["mem_pressure_spawn"])
+    room = int((mem.available - conf["mem_available_spawn"] * mem.total / 100.) / per_dock)
+    if room < spawn:
+      return room, shed, "limit", \
+             "room for %d container(s) of %d MB above %g%% of memory available" % \
+             (room, per_dock / 1048576, conf["mem_available_spawn"])
+  return spawn, shed, "accept", ""
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer, SocketServer, threading, time, re, logging
+
+# In-process registry of metrics, served in the Prometheus text format for scraping.
+# The registry is fed the same points as the InfluxDB streamers, through `point(series, tags, fields)`:
+#   - numeric and boolean fields become gauges named plancton_<series>_<field>, labelled with the tags;
+#   - string fields become gauges with value 1, labelled with the tags and the current string: the
+#     label set of the previous string is dropped. Free-text fields (see TEXT) are left out, as every
+#     new text would be a new series;
+#   - points of event series (see EVENTS) are counted instead, and one of their fields is observed in
+#     a histogram.
+# Gauges not updated for `max_age` seconds are dropped, so that removed containers disappear.
+# Updates and scrapes only hold the lock to copy values: the text is rendered outside of it, and kept
+# until the next update, so that scraping never slows down the main loop.
+
+# Fields holding free text, e.g. the reason of an admission decision: not exported.
+TEXT = set([ "reason" ])
+
+# Event series: field observed in a histogram, and its buckets.
+EVENTS = {
+  "container": ("uptime", [ 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 43200, 86400 ])
+}
+
+class MetricsRegistry(object):
+
+  def __init__(self, prefix="plancton", max_age=300):
+    self.prefix = prefix
+    self.max_age = max_age
+    self._metrics = {}   # name -> (type, { labels: value })
+    self._version = 0
+    self._cache = (None, "")
+    self._lock = threading.Lock()
+
+  def gauge(self, name, labels, value):
+    with self._lock:
+      self._samples(name, "gauge")[_key(labels)] = (float(value), time.time())
+      self._version += 1
+
+  def inc(self, name, labels, value=1):
+    with self._lock:
+      samples = self._samples(name, "counter")
+      samples[_key(labels)] = samples.get(_key(labels), 0) + value
+      self._version += 1
+
+  def observe(self, name, labels, value, buckets):
+    with self._lock:
+      samples = self._samples(name, "histogram")
+      h = samples.setdefault(_key(labels), [ [0] * len(buckets), 0, 0.0, buckets ])
+      for i, le in enumerate(buckets):
+        if value <= le:
+          h[0][i] += 1
+      h[1] += 1
+      h[2] += value
+      self._version += 1
+
+  # Update metrics from a monitoring point.
+  def point(self, series, tags, fields):
+    base = _name("%s_%s" % (self.prefix, series))
+    labels = dict([ (k, str(v)) for k, v in tags.iteritems() ])
+    if series in EVENTS:
+      field, buckets = EVENTS[series]
+      self.inc(base + "_total", labels)
+      if isinstance(fields.get(field), (int, long, float)):
+        self.observe(base + "_" + _name(field), labels, fields[field], buckets)
+      return
+    for field, value in fields.iteritems():
+      if field in TEXT:
+        continue
+      if isinstance(value, basestring):
+        self._state(base + "_" + _name(field), labels, field, value)
+      elif isinstance(value, (bool, int, long, float)):
+        self.gauge(base + "_" + _name(field), labels, value)
+
+  def _state(self, name, labels, field, value):
+    with self._lock:
+      samples = self._samples(name, "gauge")
+      key = _key(labels)
+      for k in [ k for k in samples if tuple([ x for x in k if x[0] != field ]) == key ]:
+        del samples[k]
+      samples[_key(dict(labels, **{ field: value }))] = (1.0, time.time())
+      self._version += 1
+
+  def _samples(self, name, mtype):
+    if name not in self._metrics:
+      self._metrics[name] = (mtype, {})
+    return self._metrics[name][1]
+
+  # Metrics in the Prometheus text exposition format (version 0.0.4).
+  def render(self):
+    now = time.time()
+    with self._lock:
+      if self._cache[0] == self._version:
+        return self._cache[1]
+      version = self._version
+      for mtype, samples in self._metrics.itervalues():
+        if mtype == "gauge":
+          for k in [ k for k, v in samples.iteritems() if now - v[1] > self.max_age ]:
+            del samples[k]
+      metrics = [ (name, mtype, [ (k, [ list(v[0]) ] + v[1:] if mtype == "histogram" else v)
+                                  for k, v in samples.iteritems() ])
+                  for name, (mtype, samples) in self._metrics.iteritems() ]
+    lines = []
+    for name, mtype, samples in sorted(metrics):
+      if not samples:
+        continue
+      lines.append("# TYPE %s %s" % (name, mtype))
+      for labels, v in sorted(samples):
+        if mtype == "gauge":
+          lines.append("%s%s %s" % (name, _labels(labels), _value(v[0])))
+        elif mtype == "counter":
+          lines.append("%s%s %s" % (name, _labels(labels), _value(v)))
+        else:
+          counts, count, total, buckets = v
+          for le, n in zip(buckets, counts):
+            lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", _value(le)),)), n))
+          lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", "+Inf"),)), count))
+          lines.append("%s_sum%s %s" % (name, _labels(labels), _value(total)))
+          lines.append("%s_count%s %d" % (name, _labels(labels), count))
+    text = "\n".join(lines) + "\n"
+    with self._lock:
+      self._cache = (version, text)
+    return text
+
+# Serves a MetricsRegistry over HTTP on GET /metrics, from background threads.
+class MetricsServer(object):
+
+  def __init__(self, registry, address, port):
+    self.registry = registry
+    self.address = address
+    self.port = port
+    self.logctl = logging.getLogger("metrics")
+    self._server = None
+
+  def start(self):
+    self._server = _Server((self.address, self.port), _Handler)
+    self._server.registry = self.registry
+    t = threading.Thread(target=self._server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    self.logctl.info("Serving metrics on http://%s:%d/metrics" % (self.address or "*", self.port))
+
+  def stop(self):
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+      self._server = None
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    if self.path.split("?", 1)[0] != "/metrics":
+      self.send_error(404)
+      return
+    body = self.server.registry.render()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def _key(labels):
+  return tuple(sorted(labels.iteritems()))
+
+def _name(name):
+  return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def _labels(labels):
+  if not labels:
+    return ""
+  return "{" + ",".join([ '%s="%s"' % (_name(k), v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+                          for k, v in labels ]) + "}"
+
+def _value(v):
+  v = float(v)
+  if v != v:
+    return "NaN"
+  if v in (float("inf"), float("-inf")):
+    return "+Inf" if v > 0 else "-Inf"
+  return str(int(v)) if v.is_integer() else repr(v)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os, glob, math, re, logging, threading
+
+# Placement of workers on CPUs and NUMA nodes, set with the CpusetCpus and CpusetMems container options.
+# The topology is read from /sys/devices/system/node (CPUs of each node, and the nodes having memory)
+# and /sys/devices/system/cpu (online CPUs, and hyperthreads sharing a core). Hosts without NUMA
+# information are a single node.
+# A worker needing `cpus` CPUs (possibly fractional) is given ceil(cpus) CPUs of a single node, each
+# charged its share of `cpus`: several workers with fractions of a CPU can share the same ones. Nodes
+# are filled one at a time (the fullest node where the worker fits is chosen), and within a node partly
+# used CPUs, then partly used cores come first, so that free cores stay whole for the workers needing
+# several CPUs: those get hyperthreads of the same cores, sharing their caches.
+# Allocations are keyed by worker (container ID, or name until it has one) and are thread-safe.
+
+# Parse a list of CPUs or nodes as in sysfs, e.g. "0-3,8,10-11".
+def parse_list(text):
+  ids = []
+  for part in text.strip().split(","):
+    if part:
+      first, _, last = part.partition("-")
+      ids += range(int(first), int(last or first)+1)
+  return ids
+
+def format_list(ids):
+  return ",".join([ str(x) for x in sorted(ids) ])
+
+def _read_list(path, default=None):
+  try:
+    with open(path) as f:
+      return parse_list(f.read())
+  except (IOError, ValueError):
+    return default
+
+class Topology(object):
+  def __init__(self, nodes, cores, mem_nodes):
+    self.nodes = nodes          # node -> list of CPUs
+    self.cores = cores          # CPU -> core, identified by its first hyperthread
+    self.mem_nodes = mem_nodes  # nodes with memory
+
+  @classmethod
+  def read(cls, sysfs="/sys/devices/system"):
+    online = _read_list(os.path.join(sysfs, "cpu", "online"), [])
+    nodes = {}
+    for path in glob.glob(os.path.join(sysfs, "node", "node[0-9]*")):
+      cpus = [ c for c in _read_list(os.path.join(path, "cpulist"), []) if c in online ]
+      if cpus:
+        nodes[int(re.sub(r"^.*node", "", path))] = cpus
+    if not nodes:
+      nodes = { 0: online }
+    mem_nodes = _read_list(os.path.join(sysfs, "node", "has_memory"), list(nodes))
+    cores = {}
+    for cpu in online:
+      siblings = _read_list(os.path.join(sysfs, "cpu", "cpu%d" % cpu, "topology", "thread_siblings_list"))
+      cores[cpu] = min(siblings) if siblings else cpu
+    return cls(nodes, cores, mem_nodes)
+
+# CPUs given to a worker needing `cpus` CPUs, and the share of each it is charged.
+def _shape(cpus):
+  count = max(1, int(math.ceil(cpus - 1e-9)))
+  return count, min(float(cpus) / count, 1.)
+
+class CpusetAllocator(object):
+
+  def __init__(self, topology):
+    self.topology = topology
+    self.used = dict([ (c, 0.) for cpus in topology.nodes.itervalues() for c in cpus ])
+    self.held = {}  # worker -> (node, CPUs, share of each CPU)
+    self.logctl = logging.getLogger("placement")
+    self._lock = threading.Lock()
+
+  # Reserve CPUs for a worker. Returns (CpusetCpus, CpusetMems) for its HostConfig, CpusetMems being
+  # None if the node has no memory of its own, or None if no node has enough free CPUs.
+  def allocate(self, worker, cpus):
+    with self._lock:
+      return self._allocate(worker, cpus)
+
+  # Whether a worker needing `cpus` CPUs could be placed now.
+  def fits(self, cpus):
+    with self._lock:
+      return self._best_node(cpus) is not None
+
+  # (free CPUs, node, CPUs of the node with room) of the fullest node where `cpus` fit, or None.
+  def _best_node(self, cpus):
+    count, share = _shape(cpus)
+    best = None
+    for node, node_cpus in sorted(self.topology.nodes.iteritems()):
+      fitting = [ c for c in node_cpus if self.used[c] + share <= 1. + 1e-9 ]
+      if len(fitting) < count:
+        continue
+      free = sum([ 1. - self.used[c] for c in node_cpus ])
+      if best is None or free < best[0]:
+        best = (free, node, fitting)
+    return best
+
+  def _allocate(self, worker, cpus):
+    count, share = _shape(cpus)
+    best = self._best_node(cpus)
+    if best is None:
+      self.logctl.debug("No node has %d CPU(s) with %.2f free for %s", count, share, worker)
+      return None
+    _, node, fitting = best
+    cores = self.topology.cores
+    core_used = {}
+    for c in fitting:
+      core_used[cores[c]] = core_used.get(cores[c], 0.) + self.used[c]
+    chosen = sorted(fitting, key=lambda c: (-self.used[c], -core_used[cores[c]], cores[c], c))[:count]
+    for c in chosen:
+      self.used[c] += share
+    self.held[worker] = (node, chosen, share)
+    return format_list(chosen), (str(node) if node in self.topology.mem_nodes else None)
+
+  # Account for a worker placed by a previous instance, from its CpusetCpus and CPU limit.
+  def adopt(self, worker, cpuset, cpus):
+    chosen = [ c for c in parse_list(cpuset or "") if c in self.used ]
+    with self._lock:
+      if not chosen or worker in self.held:
+        return
+      node = [ n for n, node_cpus in self.topology.nodes.iteritems() if chosen[0] in node_cpus ][0]
+      share = min(float(cpus) / len(chosen), 1.)
+      for c in chosen:
+        self.used[c] += share
+      self.held[worker] = (node, chosen, share)
+
+  # Move the allocation of a worker to another key, e.g. from its name to its ID once created.
+  def rename(self, worker, new):
+    with self._lock:
+      if worker in self.held:
+        self.held[new] = self.held.pop(worker)
+
+  # Give the CPUs of a worker back.
+  def release(self, worker):
+    with self._lock:
+      held = self.held.pop(worker, None)
+      for c in (held[1] if held else []):
+        self.used[c] = max(self.used[c] - held[2], 0.)
+
+  # CPUs used on each node.
+  def usage(self):
+    with self._lock:
+      return dict([ (node, sum([ self.used[c] for c in cpus ]))
+                    for node, cpus in self.topology.nodes.iteritems() ])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from snapshot import container_name
+
+# Workload pools: kinds of containers sharing the host, each with its own image, command and resource
+# shape (CPUs and memory per container), and a weight.
+# The host capacity is `max_docks` slots of the global shape, i.e. max_docks × cpus_per_dock CPUs and
+# max_docks × max_dock_mem bytes of memory. Pools share it by weighted dominant resource fairness: the
+# share of a pool is the largest of its fractions of the CPU and of the memory, divided by its weight.
+# New containers go to the pool with the smallest share, which waits for enough free CPU and memory
+# for its container if needed, and containers are killed from the pool with the largest share first.
+
+# Options which a pool can set, on top of the global ones, besides "weight".
+POOL_OPTIONS = [ "docker_image", "docker_cmd", "docker_privileged", "user_group", "binds", "devices",
+                 "capabilities", "security_opts", "cpus_per_dock", "max_dock_mem", "max_dock_swap" ]
+
+class Pool(object):
+  def __init__(self, name, prefix, conf, weight=1):
+    self.name = name
+    self.prefix = prefix  # names of the containers of the pool are prefix-xxxxxx
+    self.conf = conf      # global configuration with the options of the pool
+    self.weight = weight
+    self.cpus = conf["cpus_per_dock"]
+    self.mem = conf["max_dock_mem"]
+
+  def owns(self, c):
+    return container_name(c).startswith(self.prefix + "-")
+
+# Pools defined by the `pools` option. Without pools, a single "default" pool uses the global options
+# and the plain container prefix, as before pools existed.
+def make_pools(conf, prefix):
+  if not conf["pools"]:
+    return [ Pool("default", prefix, conf) ]
+  pools = []
+  for name, opts in sorted(conf["pools"].iteritems()):
+    pconf = dict(conf)
+    pconf.update([ x for x in opts.iteritems() if x[0] != "weight" and x[1] is not None ])
+    pools.append(Pool(name, "%s-%s" % (prefix, name), pconf, opts.get("weight", 1)))
+  return pools
+
+# Pool of a container, None if it belongs to none of them.
+def pool_of(pools, c):
+  for pool in pools:
+    if pool.owns(c):
+      return pool
+  return None
+
+def _share(pool, used, capacity):
+  if not pool.weight:
+    return float("inf")
+  return max(used[0] / capacity[0] if capacity[0] else 0.,
+             used[1] / capacity[1] if capacity[1] else 0.) / pool.weight
+
+# Containers to launch in each pool, given the (CPUs, memory) `used` by each pool, the total `capacity`,
+# and the `free` (CPUs, memory) that can be given to new containers. At most `limit` containers are
+# launched. When the container of the pool with the smallest share does not fit in `free`, nothing more
+# is launched: the pool waits for more CPUs and memory to be granted, instead of seeing them go to the
+# pools with smaller containers. Pools whose container does not even fit in the whole capacity are
+# skipped. Returns a dict pool -> count, without the pools getting nothing, and the waiting pool or None.
+def allocate(pools, used, capacity, free, limit):
+  used = dict([ (p, list(used.get(p, (0., 0.)))) for p in pools ])
+  free = list(free)
+  plan = {}
+  candidates = [ p for p in pools if p.weight and p.cpus <= capacity[0] + 1e-9 and p.mem <= capacity[1] ]
+  for _ in range(limit):
+    if not candidates:
+      break
+    pool = min(candidates, key=lambda p: (_share(p, used[p], capacity), p.name))
+    if pool.cpus > free[0] + 1e-9 or pool.mem > free[1]:
+      return plan, pool
+    plan[pool] = plan.get(pool, 0) + 1
+    used[pool][0] += pool.cpus
+    used[pool][1] += pool.mem
+    free[0] -= pool.cpus
+    free[1] -= pool.mem
+  return plan, None
+
+# Containers to kill to free `cpus` CPUs, at most `limit` of them (no limit if 0). `running` maps each
+# pool to its running containers, first ones to kill first; containers of no pool are under None and
+# are killed first, counting `orphan_cpus` CPUs each. Then containers are taken from the pool with the
+# largest share.
+def pick_victims(running, capacity, cpus, orphan_cpus, limit=0):
+  running = dict([ (p, list(conts)) for p, conts in running.iteritems() if conts ])
+  used = dict([ (p, [ len(conts)*p.cpus, len(conts)*p.mem ]) for p, conts in running.iteritems() if p ])
+  picked = []
+  freed = 0.
+  while freed < cpus - 1e-9 and running and (not limit or len(picked) < limit):
+    pool = max(running, key=lambda p: (p is None, p and _share(p, used[p], capacity), p and p.name))
+    picked.append(running[pool].pop(0))
+    if not running[pool]:
+      del running[pool]
+    if pool is None:
+      freed += orphan_cpus
+    else:
+      freed += pool.cpus
+      used[pool][0] -= pool.cpus
+      used[pool][1] -= pool.mem
+  return picked
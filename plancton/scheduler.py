@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import logging, math
+
+# Scheduler policies decide, at every main loop, how many containers to launch and how many to
+# remove. They are given a `Load` describing the host and the configuration, and return a pair
+# (spawn, shed). `metrics()` returns the policy internals, which are sent to monitoring.
+# Policies are selected by name with the `scheduler` configuration option, see `policies`.
+
+class Load(object):
+  def __init__(self, now, efficiency, idle, running, ncpus, last_kill):
+    self.now = now                # current time
+    self.efficiency = efficiency  # smoothed host CPU load (%)
+    self.idle = idle              # CPU available for new containers (%)
+    self.running = running        # running containers
+    self.ncpus = ncpus
+    self.last_kill = last_kill    # last time a container was killed
+
+# Most containers that may be killed in one loop.
+def kill_limit(load, conf):
+  return min(conf["kills_per_loop"] or load.running, load.running)
+
+class SchedulerPolicy(object):
+  name = None
+  def __init__(self):
+    self.logctl = logging.getLogger("scheduler")
+  def decide(self, load, conf):
+    raise NotImplementedError
+  def metrics(self):
+    return {}
+
+# Historical policy: fill the idle CPUs, kill containers after being over threshold for `grace_kill`
+# seconds, and do not launch anything for `grace_spawn` seconds after a kill. As many containers are
+# killed at once as needed to bring the host load back to `cpu_setpoint`, and at least one.
+class HeuristicPolicy(SchedulerPolicy):
+  name = "heuristic"
+
+  def __init__(self):
+    super(HeuristicPolicy, self).__init__()
+    self._overhead_first_time = 0
+    self.fitting = 0
+    self.threshold = 0
+
+  def decide(self, load, conf):
+    spawn = shed = 0
+    self.threshold = 100. * conf["cpus_per_dock"] * min(load.running, conf["max_docks"]) / load.ncpus
+    if self.threshold and load.efficiency > self.threshold+10.:
+      if self._overhead_first_time == 0:
+        self._overhead_first_time = load.now
+      self.logctl.warning("Above CPU threshold of %.2f%% for %d/%d s",
+                          self.threshold, load.now-self._overhead_first_time, conf["grace_kill"])
+      if load.now-self._overhead_first_time > conf["grace_kill"]:
+        per_dock = 100. * conf["cpus_per_dock"] / load.ncpus
+        shed = max(1, int(math.ceil((load.efficiency-conf["cpu_setpoint"]) / per_dock)))
+        shed = min(shed, kill_limit(load, conf))
+    else:
+      self._overhead_first_time = 0
+    self.fitting = int(load.idle*0.95*load.ncpus/(conf["cpus_per_dock"]*100))
+    self.logctl.debug("Potentially fitting containers based on CPU utilisation: %d", self.fitting)
+    launchable = min(self.fitting, max(conf["max_docks"]-load.running, 0), conf["docks_per_loop"])
+    if load.now-load.last_kill > conf["grace_spawn"]:
+      spawn = launchable
+    elif launchable > 0:
+      self.logctl.info("Not launching %d containers: too little time since last kill", launchable)
+    return spawn, shed
+
+  def metrics(self):
+    return { "fitting": self.fitting,
+             "threshold": self.threshold }
+
+# Proportional-integral controller keeping the host CPU load at `cpu_setpoint` percent. CPU pressure
+# counts as load. The error (setpoint minus load) is expressed in containers, i.e. divided by the share of
+# the host a container may use. The integral term holds the container count the controller converges to:
+# it is initialized with the running containers and, to prevent windup, never goes further than
+# `docks_per_loop` above them or `kills_per_loop` below them, nor outside [0, max_docks]. Its gain is
+# applied over the time elapsed since the last loop, and at most half of the error is integrated in one
+# loop, so that the controller does not overshoot whatever `main_sleep` is. The target is the sum of
+# both terms: containers are launched towards it by at most `docks_per_loop` per loop, and the excess
+# is killed within `kills_per_loop` once the target has stayed below the running containers for
+# `grace_kill` seconds, so that a short load peak does not kill anything. The integral is not updated
+# meanwhile, so that the kills do not overshoot.
+# Errors smaller than one container are ignored, and the integral is reset to the running containers:
+# when the setpoint falls between two container counts, the controller holds either instead of
+# alternating between them.
+class PIPolicy(SchedulerPolicy):
+  name = "pi"
+
+  def __init__(self):
+    super(PIPolicy, self).__init__()
+    self.integral = None
+    self.error = 0.
+    self.proportional = 0.
+    self.target = 0
+    self._last = None
+    self._over_since = None  # since when the target is below the running containers
+
+  def decide(self, load, conf):
+    per_dock = 100. * conf["cpus_per_dock"] / load.ncpus
+    busy = 100. - load.idle
+    self.error = (conf["cpu_setpoint"] - busy) / per_dock
+    if abs(self.error) < 1.:
+      self.error = 0.  # less than a container away: hold, to avoid spawning and killing in turn
+      self.integral = float(load.running)
+    elif self.integral is None:
+      self.integral = float(load.running)
+    elif self._over_since is not None and load.now - self._over_since < conf["grace_kill"]:
+      pass  # kills are held: the excess is not integrated again and again
+    else:
+      dt = min(load.now - self._last, 10.*conf["main_sleep"])
+      self.integral += min(conf["pi_ki"] * dt, 0.5) * self.error
+    self.integral = min(max(self.integral, 0., load.running-kill_limit(load, conf)),
+                        float(conf["max_docks"]), load.running+conf["docks_per_loop"])
+    self._last = load.now
+    self.proportional = conf["pi_kp"] * self.error
+    self.target = int(round(min(max(self.integral + self.proportional, 0.), conf["max_docks"])))
+    self.logctl.debug("Load %.2f%%, setpoint %.2f%%: error %.2f, P %.2f, I %.2f, target %d containers",
+                      busy, conf["cpu_setpoint"], self.error, self.proportional, self.integral, self.target)
+    delta = self.target - load.running
+    if delta >= 0:
+      self._over_since = None
+    elif self._over_since is None:
+      self._over_since = load.now
+    if delta < 0 and load.now - self._over_since < conf["grace_kill"]:
+      self.logctl.info("%d container(s) above target for %d/%d s, not killing yet",
+                       -delta, load.now - self._over_since, conf["grace_kill"])
+      delta = 0
+    return min(max(delta, 0), conf["docks_per_loop"]), min(max(-delta, 0), kill_limit(load, conf))
+
+  def metrics(self):
+    return { "error": self.error,
+             "proportional": self.proportional,
+             "integral": self.integral or 0.,
+             "target": self.target }
+
+policies = dict([ (p.name, p) for p in [ HeuristicPolicy, PIPolicy ] ])
+
+# Victim policies order the running containers to kill, first ones first. They are given the containers
+# youngest first and their usage as read from cgroups: containers without usage keep their order.
+def _usage(usage, c, key):
+  return (usage.get(c["Id"]) or {}).get(key) or 0
+
+victims = {
+  "youngest":  lambda conts, usage: conts,
+  "least_cpu": lambda conts, usage: sorted(conts, key=lambda c: _usage(usage, c, "cpu_time")),
+  "most_mem":  lambda conts, usage: sorted(conts, key=lambda c: -_usage(usage, c, "mem"))
+}
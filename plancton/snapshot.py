@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import time
+
+# Point-in-time view of the containers of Plancton known to the Docker daemon.
+# It is built from a single `containers(all=True)` call, filtered by Docker on the owner label of the
+# workers, and indexed by id, state and name prefix, so that every consumer in a main loop tick can
+# share it instead of listing containers again.
+
+# Label set on workers at creation, with the container prefix as value. Workers are listed by it.
+OWNER_LABEL = "plancton.owner"
+
+# Container name as shown by Docker, without the leading slash.
+def container_name(c):
+  return (c.get("Names") or [""])[0][1:]
+
+# Normalized container state. Older API versions only report `Status`.
+def container_state(c):
+  state = c.get("State")
+  if isinstance(state, basestring) and state:
+    return state.lower()
+  status = c.get("Status", "").lower()
+  if status.startswith("up"):
+    return "running"
+  for s in [ "exited", "created", "restarting", "removal", "dead" ]:
+    if status.startswith(s):
+      return s
+  return status
+
+class ContainerSnapshot(object):
+  def __init__(self, containers):
+    self.containers = containers
+    self.taken = time.time()
+    self.by_id = {}
+    self.by_state = {}
+    self._by_prefix = {}
+    for c in containers:
+      self.by_id[c["Id"]] = c
+      self.by_state.setdefault(container_state(c), []).append(c)
+
+  # Containers whose name starts with `prefix`.
+  def with_prefix(self, prefix):
+    if prefix not in self._by_prefix:
+      self._by_prefix[prefix] = [ c for c in self.containers if container_name(c).startswith(prefix) ]
+    return self._by_prefix[prefix]
+
+  # Running containers whose name starts with `prefix`.
+  def running(self, prefix):
+    return [ c for c in self.with_prefix(prefix) if container_state(c) == "running" ]
+
+  def __len__(self):
+    return len(self.containers)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import threading, time, math
+from collections import deque
+
+# Rolling duration statistics of named operations (main loop phases, Docker API calls).
+# Each name keeps its last `window` samples, from which percentiles are computed on demand. Samples
+# can be recorded from any thread, either with `record()` or by timing a block:
+#   with timings.timer("tick.launch"):
+#     ...
+
+class Timings(object):
+
+  def __init__(self, window=500):
+    self.window = window
+    self._samples = {}  # name -> deque of the last durations (s)
+    self._counts = {}   # name -> number of samples ever recorded
+    self._times = {}    # name -> epoch of the last sample
+    self._lock = threading.Lock()
+
+  def record(self, name, seconds):
+    with self._lock:
+      if name not in self._samples:
+        self._samples[name] = deque(maxlen=self.window)
+        self._counts[name] = 0
+      self._samples[name].append(seconds)
+      self._counts[name] += 1
+      self._times[name] = time.time()
+
+  def timer(self, name):
+    return _Timer(self, name)
+
+  # Last sample of each name, only of names recorded at or after epoch `since` if given.
+  def last(self, prefix="", since=None):
+    with self._lock:
+      return dict([ (k, v[-1]) for k, v in self._samples.iteritems()
+                    if k.startswith(prefix) and (since is None or self._times[k] >= since) ])
+
+  # Statistics of each name: samples ever recorded, and percentiles, max and last of the window (s).
+  def summary(self):
+    with self._lock:
+      samples = dict([ (k, list(v)) for k, v in self._samples.iteritems() ])
+      counts = dict(self._counts)
+    summary = {}
+    for name, values in samples.iteritems():
+      last = values[-1]
+      values.sort()
+      summary[name] = { "count": counts[name],
+                        "p50": _percentile(values, 50),
+                        "p95": _percentile(values, 95),
+                        "p99": _percentile(values, 99),
+                        "max": values[-1],
+                        "last": last }
+    return summary
+
+class _Timer(object):
+  def __init__(self, timings, name):
+    self.timings = timings
+    self.name = name
+  def __enter__(self):
+    self.start = time.time()
+    return self
+  def __exit__(self, *exc):
+    self.timings.record(self.name, time.time() - self.start)
+    return False
+
+# Nearest-rank percentile of sorted values.
+def _percentile(values, p):
+  return values[max(0, int(math.ceil(p / 100. * len(values))) - 1)]